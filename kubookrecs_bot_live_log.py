@@ -14,21 +14,51 @@ KUBookRecs: Auto-Reply Bot (GO-LIVE V3)
 Usage (example):
     export REDDIT_USERNAME="Arijenn2891"
     export REDDIT_PASSWORD="your-app-password-or-pass:code"
-    python kubookrecs_bot_live_log.py
+    python kubookrecs_bot_live_log.py                    # one pass (cron)
+    python kubookrecs_bot_live_log.py --daemon           # stay up, reply from the live stream
+    python kubookrecs_bot_live_log.py compile-catalog    # rebuild the binary catalog
 """
 
-import os, re, time, traceback
+import os, re, sys, csv, time, json, zlib, random, shutil, atexit, signal, sqlite3, hashlib, argparse, traceback
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import datetime, timezone
+from urllib.parse import urlsplit
+import numpy as np
 import pandas as pd
 import praw
+import prawcore
 from praw.exceptions import APIException, RedditAPIException
 
 # -------------------- CONFIG --------------------
 ALLOWED_SUBS = ["kubookrecs", "books"]
 LIMIT_PER_SUB = 25
+MULTIREDDIT = os.getenv("MULTIREDDIT", "1") != "0"   # one r/a+b listing instead of one per sub
 MAX_REPLIES_PER_RUN = 3
 COOLDOWN_SECONDS = 120
+# Reply token buckets: account-wide rate/burst (default one per COOLDOWN_SECONDS) and per sub.
+REPLY_RATE_PER_MIN = float(os.getenv("REPLY_RATE_PER_MIN", 60 / COOLDOWN_SECONDS))
+REPLY_BURST = int(os.getenv("REPLY_BURST", "1"))
+SUB_REPLY_RATE_PER_HOUR = float(os.getenv("SUB_REPLY_RATE_PER_HOUR", "10"))
+SUB_REPLY_BURST = int(os.getenv("SUB_REPLY_BURST", "2"))
+RUN_BUDGET_SECONDS = int(os.getenv("RUN_BUDGET_SECONDS", "720"))   # cron run: stop sending after this
+# Failed sends: 5xx / network errors back off exponentially (with jitter) up to the max.
+BACKOFF_BASE_SECONDS = float(os.getenv("BACKOFF_BASE_SECONDS", "30"))
+BACKOFF_MAX_SECONDS = float(os.getenv("BACKOFF_MAX_SECONDS", "1800"))
+MAX_SEND_ATTEMPTS = int(os.getenv("MAX_SEND_ATTEMPTS", "4"))
 MAX_POST_AGE_HOURS = 24
+STREAM_PAUSE_AFTER = 3   # --daemon: empty stream polls before yielding control back
+SCORING_MODE = os.getenv("SCORING_MODE", "vectorized")   # "vectorized" | "rowwise"
+VERIFY_REPLIED = os.getenv("VERIFY_REPLIED", "1") != "0"  # comment-tree walk when the local index misses
+STATE_DB = os.getenv("STATE_DB", "kubookrecs_state.sqlite3")
+PICK_CACHE_SIZE = int(os.getenv("PICK_CACHE_SIZE", "1024"))  # LRU entries of pick_books results (0 = off)
+STRICT_FILTERS = os.getenv("STRICT_FILTERS", "0") == "1"  # hard_nopes / max_pages exclude books instead of -4 / -2
+LOG_PATH = os.getenv("LOG_PATH", "")   # CSV run log, one row per evaluated post (empty = off)
+LOG_FLUSH_ROWS = int(os.getenv("LOG_FLUSH_ROWS", "50"))
+API_RESERVE = int(os.getenv("API_RESERVE", "30"))   # requests per rate-limit window kept for essential calls
+# Stage latency summaries written at run end (empty = off).
+METRICS_PROM = os.getenv("METRICS_PROM", "")   # Prometheus textfile
+METRICS_JSON = os.getenv("METRICS_JSON", "")
 
 # App credentials (env overrides supported)
 CLIENT_ID = os.getenv("REDDIT_CLIENT_ID", "y0jPsjIR2NsSKS32H1-xOQ")
@@ -40,6 +70,8 @@ USERNAME = os.getenv("REDDIT_USERNAME", "")
 PASSWORD = os.getenv("REDDIT_PASSWORD", "")
 
 CSV_PATH = "book_recommendations.csv"
+# Binary catalog written by `compile-catalog`; used while it matches CSV_PATH.
+CATALOG_PATH = os.getenv("CATALOG_PATH", "book_recommendations.catalog")
 
 # -------------------- CONNECT --------------------
 def connect():
@@ -51,16 +83,112 @@ def connect():
         user_agent=USER_AGENT,
         username=USERNAME,
         password=PASSWORD,
+        requestor_class=CountingRequestor,
         check_for_async=False
     )
-    me = str(reddit.user.me())
+    with api_stage("connect"):
+        me = str(reddit.user.me())
     print(f"Authenticated as: {me}")
     return reddit, me
 
+# -------------------- API ACCOUNTING --------------------
+def endpoint_of(url):
+    # Collapse ids and usernames so calls group by endpoint rather than by post.
+    path = urlsplit(url).path.rstrip("/") or "/"
+    path = re.sub(r"/comments/[^/]+", "/comments/{id}", path)
+    return re.sub(r"/(user|u)/[^/]+", r"/\1/{name}", path)
+
+class ApiUsage:
+    """Reddit requests and response bytes per (endpoint, stage), plus the
+    rate-limit window from the latest X-Ratelimit-* headers."""
+
+    def __init__(self):
+        self.calls, self.stage, self.skipped_walks = {}, "other", 0
+        self.remaining = self.used = self.reset_at = None
+
+    def record(self, method, url, response):
+        key = (f"{method.upper()} {endpoint_of(url)}", self.stage)
+        calls, nbytes = self.calls.get(key, (0, 0))
+        self.calls[key] = (calls + 1, nbytes + len(response.content or b""))
+        headers = response.headers
+        if "x-ratelimit-remaining" in headers:
+            self.remaining = float(headers["x-ratelimit-remaining"])
+            self.used = int(float(headers.get("x-ratelimit-used", 0)))
+            self.reset_at = time.time() + float(headers.get("x-ratelimit-reset", 0))
+
+    def budget(self):
+        # Requests left in the current window, or None when unknown or the window has reset.
+        if self.remaining is None or time.time() >= self.reset_at:
+            return None
+        return self.remaining
+
+    def can_afford(self, calls=1):
+        left = self.budget()
+        return left is None or left - calls >= API_RESERVE
+
+    def summary(self):
+        by = {"endpoint": {}, "stage": {}}
+        for (endpoint, stage), (calls, nbytes) in sorted(self.calls.items()):
+            for kind, name in (("endpoint", endpoint), ("stage", stage)):
+                c, b = by[kind].get(name, (0, 0))
+                by[kind][name] = (c + calls, b + nbytes)
+        as_dict = lambda d: {k: {"calls": c, "bytes": b} for k, (c, b) in d.items()}
+        return {"calls": sum(c for c, _ in self.calls.values()),
+                "bytes": sum(b for _, b in self.calls.values()),
+                "by_endpoint": as_dict(by["endpoint"]), "by_stage": as_dict(by["stage"]),
+                "ratelimit_remaining": self.remaining, "ratelimit_used": self.used,
+                "skipped_verify_walks": self.skipped_walks}
+
+    def prometheus(self):
+        lines = ["# HELP kubookrecs_api_calls_total Reddit API requests this run.",
+                 "# TYPE kubookrecs_api_calls_total counter"]
+        lines += [f'kubookrecs_api_calls_total{{endpoint="{e}",stage="{st}"}} {c}'
+                  for (e, st), (c, _) in sorted(self.calls.items())]
+        lines += ["# HELP kubookrecs_api_response_bytes_total Reddit API response bytes this run.",
+                  "# TYPE kubookrecs_api_response_bytes_total counter"]
+        lines += [f'kubookrecs_api_response_bytes_total{{endpoint="{e}",stage="{st}"}} {b}'
+                  for (e, st), (_, b) in sorted(self.calls.items())]
+        if self.remaining is not None:
+            lines += ["# HELP kubookrecs_api_ratelimit_remaining Requests left in the rate-limit window.",
+                      "# TYPE kubookrecs_api_ratelimit_remaining gauge",
+                      f"kubookrecs_api_ratelimit_remaining {self.remaining:g}"]
+        return "\n".join(lines) + "\n"
+
+    def report(self):
+        s = self.summary()
+        left = "unknown" if self.remaining is None else f"{self.remaining:g}"
+        stages = ", ".join(f"{k} {v['calls']}" for k, v in s["by_stage"].items())
+        print(f"API: {s['calls']} calls ({stages}), {s['bytes'] / 1024:.0f} KiB; "
+              f"{left} left in window, {self.skipped_walks} verify walks skipped.")
+
+API_USAGE = ApiUsage()
+
+class CountingRequestor(prawcore.Requestor):
+    """prawcore requestor that reports every HTTP call to API_USAGE."""
+
+    def request(self, *args, **kwargs):
+        response = super().request(*args, **kwargs)
+        method = args[0] if args else kwargs.get("method", "")
+        url = args[1] if len(args) > 1 else kwargs.get("url", "")
+        API_USAGE.record(method, url, response)
+        return response
+
+@contextmanager
+def api_stage(stage):
+    # Attribute the requests made inside the block to `stage`.
+    prev, API_USAGE.stage = API_USAGE.stage, stage
+    try:
+        yield
+    finally:
+        API_USAGE.stage = prev
+
 # -------------------- DATA --------------------
 REQUIRED_COLS = ["title","author","year","genres","tropes","vibes","heat","pacing",
                  "format_availability","ku","audio","pages","content_notes","comps",
                  "hook_line","why_readers_might_like"]
+# Lowercased copies of the columns scoring matches against, built once per load.
+# Comps are matched whole, by normalized name (comps_norm), not as substrings.
+SEARCH_COLS = ["genres","tropes","vibes","heat","content_notes"]
 
 def load_books(path):
     df = pd.read_csv(path, dtype=str).fillna("")
@@ -70,8 +198,201 @@ def load_books(path):
     df["ku"] = df["ku"].str.lower().isin(["true","1","yes","y"])
     df["audio"] = df["audio"].str.lower().isin(["true","1","yes","y"])
     df["pages"] = pd.to_numeric(df["pages"], errors="coerce").fillna(0).astype(int)
+    for c in SEARCH_COLS:
+        df[c + "_lc"] = df[c].str.lower()
+    df["comps_norm"] = df["comps"].map(normalize_comps)
     return df
 
+# -------------------- INDEX --------------------
+# Inverted term index: for each column, the split terms map to the rows holding them.
+# Stored CSR-style (sorted terms, indptr, rows) so a term's rows are one slice.
+INDEX_COLS = {"genres": r"\|", "tropes": r"\|", "vibes": r"\|", "comps": r"\|",
+              "format_availability": r"\|", "heat": r"\|", "content_notes": r"[;,]"}
+
+def build_postings(col, sep):
+    terms = col.reset_index(drop=True).str.lower().str.split(sep, regex=True).explode().str.strip()
+    terms = terms[terms.notna() & (terms != "")]
+    pairs = pd.DataFrame({"row": terms.index.to_numpy(), "term": terms.to_numpy()}).drop_duplicates()
+    codes, uniques = pd.factorize(pairs["term"], sort=True)
+    order = np.argsort(codes, kind="stable")
+    rows = pairs["row"].to_numpy()[order].astype(np.int32)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(uniques)))]).astype(np.int64)
+    return np.asarray(uniques, dtype=str), indptr, rows
+
+NEGATED_NOTE = re.compile(r"^(?:no|zero|without|none)\b")
+
+def normalize_notes(cell):
+    # "no gore; war violence (off-page)" -> "war violence": parentheticals go, and
+    # notes that say a thing is absent are not warnings about it.
+    notes = (re.sub(r"\(.*?\)", "", n).strip() for n in re.split(r"[;,]", cell.lower()))
+    return "|".join(n for n in notes if n and not NEGATED_NOTE.match(n))
+
+def normalize_comps(cell):
+    # "Fourth Wing|The Hunger Games" -> "fourth wing|the hunger games"
+    return "|".join(filter(None, (normalize_name(c) for c in str(cell).split("|"))))
+
+def build_index(df, version=""):
+    index = {"n": len(df), "version": version, "postings": {}, "_memo": {}}
+    for c, sep in INDEX_COLS.items():
+        index["postings"][c] = build_postings(df[c], sep)
+    index["postings"]["content_notes_norm"] = build_postings(df["content_notes"].map(normalize_notes), r"\|")
+    index["postings"]["title_norm"] = build_postings(df["title"].map(normalize_name), r"\|")
+    index["postings"]["comps_norm"] = build_postings(df["comps_norm"], r"\|")
+    index["ku_rows"] = np.flatnonzero(df["ku"].to_numpy(dtype=bool)).astype(np.int32)
+    index["audio_rows"] = np.flatnonzero(df["audio"].to_numpy(dtype=bool)).astype(np.int32)
+    index["pages"] = df["pages"].to_numpy(dtype=np.int64)
+    index["year"] = book_years(df)
+    index["pages_order"] = np.argsort(index["pages"], kind="stable").astype(np.int32)
+    index["pages_sorted"] = index["pages"][index["pages_order"]]
+    index["graph_indptr"], index["graph_indices"], index["graph_weights"] = build_graph(df, index)
+    index["bm25_terms"], index["bm25_indptr"], index["bm25_rows"], index["bm25_impact"] = build_bm25(df)
+    index.update(build_embeddings(df))
+    index["feature_bits"], index["author_ids"] = build_feature_bits(df, index)
+    index.update(build_mentions(df))
+    return index
+
+def book_years(df):
+    return pd.to_numeric(df["year"], errors="coerce").fillna(0).to_numpy(dtype=np.int64)
+
+def load_catalog(path, artifact=CATALOG_PATH):
+    if artifact and artifact_is_fresh(artifact, path):
+        return load_artifact(artifact)
+    if artifact and os.path.exists(artifact):
+        print(f"Catalog artifact {artifact} is stale; parsing {path}.")
+    books = load_books(path)
+    return books, build_index(books, version=file_sha256(path))
+
+# -------------------- CATALOG ARTIFACT --------------------
+# A directory of .npy files (one per column / index array) plus manifest.json.
+# Every ndarray at the top level of the index is persisted; keys starting with "_"
+# are per-process scratch. Text columns are stored packed (see pack_strings).
+ARTIFACT_FORMAT = 10
+
+def pack_strings(values):
+    # NUL-terminated UTF-8 in one uint8 blob, plus each string's start offset. A tenth
+    # of the size of a fixed-width (UTF-32) str array, and a whole column decodes with
+    # one decode + split.
+    data = [str(v).encode("utf-8") + b"\0" for v in values]
+    if any(d.count(b"\0") > 1 for d in data):
+        raise ValueError("strings containing NUL cannot be packed")
+    offsets = np.zeros(len(data) + 1, dtype=np.int64)
+    np.cumsum([len(d) for d in data], out=offsets[1:])
+    return np.frombuffer(b"".join(data), dtype=np.uint8), offsets
+
+def unpack_strings(blob):
+    return blob.tobytes().decode("utf-8").split("\0")[:-1]
+
+def string_at(blob, offsets, i):
+    return blob[offsets[i]:offsets[i + 1] - 1].tobytes().decode("utf-8")
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def source_fingerprint(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": file_sha256(path)}
+
+def read_manifest(artifact):
+    try:
+        with open(os.path.join(artifact, "manifest.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def artifact_is_fresh(artifact, path):
+    # Same size + mtime is trusted as-is; otherwise (fresh checkout, cache restore)
+    # the content hash decides.
+    manifest = read_manifest(artifact)
+    if not manifest or manifest.get("format") != ARTIFACT_FORMAT:
+        return False
+    src, st = manifest["source"], os.stat(path)
+    if (src["size"], src["mtime_ns"]) == (st.st_size, st.st_mtime_ns):
+        return True
+    return src["size"] == st.st_size and src["sha256"] == file_sha256(path)
+
+def compile_catalog(path=CSV_PATH, artifact=CATALOG_PATH, force=False):
+    if not force and artifact_is_fresh(artifact, path):
+        print(f"Catalog artifact {artifact} is up to date.")
+        return
+    source = source_fingerprint(path)
+    books = load_books(path)
+    index = build_index(books, version=source["sha256"])
+    tmp = artifact + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    arrays = {}
+    for c in books.columns:
+        col = books[c]
+        if pd.api.types.is_numeric_dtype(col):
+            arrays["col." + c] = col.to_numpy()
+        else:
+            arrays["text." + c], _ = pack_strings(col)
+    for c, (terms, indptr, rows) in index["postings"].items():
+        arrays[f"postings.{c}.terms"], arrays[f"postings.{c}.indptr"], arrays[f"postings.{c}.rows"] = terms, indptr, rows
+    for k, v in index.items():
+        if isinstance(v, np.ndarray) and not k.startswith("_"):
+            arrays["index." + k] = v
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmp, name + ".npy"), arr, allow_pickle=False)
+    manifest = {"format": ARTIFACT_FORMAT, "source": source, "n": len(books),
+                "columns": list(books.columns), "arrays": sorted(arrays)}
+    with open(os.path.join(tmp, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+    shutil.rmtree(artifact, ignore_errors=True)
+    os.rename(tmp, artifact)
+    print(f"Compiled {len(books)} books into {artifact}.")
+
+def load_artifact(artifact):
+    manifest = read_manifest(artifact)
+    arrays = {name: np.load(os.path.join(artifact, name + ".npy"), mmap_mode="r")
+              for name in manifest["arrays"]}
+    books = pd.DataFrame({c: arrays["col." + c] if "col." + c in arrays else unpack_strings(arrays["text." + c])
+                          for c in manifest["columns"]})
+    index = {"n": manifest["n"], "version": manifest["source"]["sha256"], "postings": {}, "_memo": {}}
+    for name in arrays:
+        if name.startswith("postings.") and name.endswith(".terms"):
+            c = name[len("postings."):-len(".terms")]
+            index["postings"][c] = tuple(arrays[f"postings.{c}.{part}"] for part in ("terms", "indptr", "rows"))
+    for name, arr in arrays.items():
+        if name.startswith("index."):
+            index[name[len("index."):]] = arr
+    return books, index
+
+def term_rows(index, col, query):
+    # Rows whose `col` holds a term containing `query` (the same substring test as
+    # contains_any). Only for the small tag vocabularies (genres, tropes, vibes,
+    # heat, notes); comps and titles go through exact_rows.
+    key = (col, query)
+    memo = index["_memo"]
+    if key not in memo:
+        terms, indptr, rows = index["postings"][col]
+        hits = [i for i, t in enumerate(terms) if query in t]
+        found = [rows[indptr[i]:indptr[i+1]] for i in hits]
+        if len(memo) > 4096:
+            memo.clear()
+        memo[key] = np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int32)
+    return memo[key]
+
+def exact_rows(index, col, term):
+    terms, indptr, rows = index["postings"][col]
+    i = np.searchsorted(terms, term)
+    if i < len(terms) and terms[i] == term:
+        return rows[indptr[i]:indptr[i+1]]
+    return np.empty(0, dtype=np.int32)
+
+def rows_any(index, col, queries):
+    found = [term_rows(index, col, q.lower()) for q in queries]
+    return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int32)
+
+def comp_rows(index, names):
+    # Books listing any of `names` as a comp, by normalized name: one binary search each.
+    found = [exact_rows(index, "comps_norm", normalize_name(name)) for name in names]
+    return np.unique(np.concatenate(found)) if found else np.empty(0, dtype=np.int32)
+
 # -------------------- PREFS EXTRACTION --------------------
 GENRES = ["romance","romantic suspense","cozy mystery","mystery","thriller",
           "fantasy","science fiction","sci-fi","space opera",
@@ -82,19 +403,81 @@ TROPES = ["found family","enemies to lovers","slow burn","grumpy sunshine",
 VIBES  = ["hopeful","dark","witty","cozy","bittersweet","gritty","tender","atmospheric","high-octane","epic","steady","fast"]
 NOPE_KEYWORDS = ["animal death","on-page sa","sexual assault","cheating","graphic violence","gore"]
 
-def extract_prefs(text: str):
+# Word tokens; hyphens split words ("sci-fi" == "sci fi") so matches land on word boundaries.
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z0-9]+)*")
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower().replace("\u2019", "'"))
+
+class TermMatcher:
+    """Aho-Corasick automaton over word tokens: finds every phrase in one pass over a text."""
+
+    def __init__(self):
+        self.goto, self.fail, self.out = [{}], [0], [[]]
+
+    def add(self, phrase, value):
+        node = 0
+        for tok in tokenize(phrase):
+            nxt = self.goto[node].get(tok)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto.append({}); self.fail.append(0); self.out.append([])
+                self.goto[node][tok] = nxt
+            node = nxt
+        if node:
+            self.out[node].append(value)
+        return self
+
+    def build(self):
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for tok, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and tok not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(tok, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+                queue.append(nxt)
+        return self
+
+    def find(self, tokens):
+        # Yields (index of the match's last token, value) for every match.
+        node = 0
+        for i, tok in enumerate(tokens):
+            while node and tok not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(tok, 0)
+            for value in self.out[node]:
+                yield i, value
+
+def build_prefs_matcher():
+    m = TermMatcher()
+    def add(phrase, value):
+        m.add(phrase, value)
+        # plural of the last word: "heists", "romances", "found families"
+        m.add(phrase[:-1] + "ies" if re.search(r"[^aeiou]y$", phrase) else phrase + "s", value)
+    for i, g in enumerate(GENRES):
+        add(g, ("genres_like", i, "WWII historical fiction" if g=="wwii" else g))
+    for i, t in enumerate(TROPES):
+        add(t, ("tropes", i, t))
+    for i, v in enumerate(VIBES):
+        add(v, ("vibes", i, v))
+    for i, nope in enumerate(NOPE_KEYWORDS):
+        add(nope, ("hard_nopes", i, nope))
+        add(f"no {nope.split()[0]}", ("hard_nopes", i, nope))
+    return m.build()
+
+PREFS_MATCHER = build_prefs_matcher()
+
+def extract_prefs(text: str, index=None):
     low = text.lower()
     prefs = {
         "genres_like": [], "tropes": [], "vibes": [], "heat": None,
-        "ku": None, "audio": None, "hard_nopes": [], "max_pages": None, "comps_like": []
+        "ku": None, "audio": None, "hard_nopes": [], "max_pages": None, "comps_like": [],
+        "read_titles": [], "like_titles": [], "text_terms": []
     }
-    for g in GENRES:
-        if g in low:
-            prefs["genres_like"].append("WWII historical fiction" if g=="wwii" else g)
-    for t in TROPES:
-        if t in low: prefs["tropes"].append(t)
-    for v in VIBES:
-        if v in low: prefs["vibes"].append(v)
+    for key, _, label in sorted({v for _, v in PREFS_MATCHER.find(tokenize(low))}):
+        prefs[key].append(label)
     if re.search(r"\bclosed(-|\s)?door\b|clean\b", low): prefs["heat"] = "closed"
     elif "fade to black" in low: prefs["heat"] = "fade"
     elif re.search(r"\bopen(-|\s)?door\b|spice|steamy|spicy", low): prefs["heat"] = "open"
@@ -102,19 +485,345 @@ def extract_prefs(text: str):
     if "audiobook" in low or "audio" in low: prefs["audio"] = True
     m = re.search(r"(?:under|<)\s*(\d{2,4})\s*pages", low)
     if m: prefs["max_pages"] = int(m.group(1))
-    for nope in NOPE_KEYWORDS:
-        if nope in low or f"no {nope.split()[0]}" in low:
-            prefs["hard_nopes"].append(nope)
     m2 = re.search(r"like\s+([A-Za-z0-9'\":\- ]{3,60})", text, flags=re.I)
     if m2: prefs["comps_like"].append(m2.group(1).strip())
+    if index is not None:
+        add_mentions(prefs, text, index)
+        prefs["text_terms"] = query_terms(index, text)
     return prefs
 
+# -------------------- MENTIONS --------------------
+# Catalog titles, authors and comp titles named anywhere in a post. Every name form
+# is stored by the crc32 of its normalized text (sorted, so it persists in the
+# compiled catalog and loads without a rebuild); a post's token n-grams are hashed
+# and looked up in one searchsorted, then checked against the stored form. Every
+# mention is a comp signal; a catalog title named after "already read ..." or
+# "like ..." is also excluded from the picks (the poster has read it).
+MENTION_KINDS = ("title", "author", "comp")
+READ_CUE = re.compile(r"\b(?:already\s+(?:read|finished)|i'?ve\s+(?:read|finished)|have\s+(?:read|finished)|"
+                      r"i\s+(?:read|finished)|done\s+with)\b")
+LIKE_CUE = re.compile(r"\b(?:like|similar\s+to|loved|enjoyed|fans?\s+of)\b")
+CLAUSE_END = re.compile(r"[.!?\n]")
+
+def normalize_name(name):
+    return " ".join(tokenize(name))
+
+def mention_forms(name):
+    # The normalized name, plus the title without a leading article. Single short
+    # words ("It", "Us") are skipped: they would match ordinary prose.
+    norm = normalize_name(name)
+    forms = {norm}
+    for art in ("the ", "a ", "an "):
+        if norm.startswith(art):
+            forms.add(norm[len(art):])
+    return [f for f in forms if " " in f or len(f) >= 6]
+
+def build_mentions(df):
+    entries = []
+    for kind, col in zip(range(len(MENTION_KINDS)),
+                         (df["title"], df["author"], df["comps"].str.split("|").explode())):
+        for name in pd.unique(col.dropna()):
+            name = str(name).strip()
+            for form in mention_forms(name):
+                entries.append((zlib.crc32(form.encode("utf-8")), form, kind, name, form.count(" ") + 1))
+    entries.sort(key=lambda e: e[0])   # stable: one form's entries keep title, author, comp order
+    forms, form_offsets = pack_strings(e[1] for e in entries)
+    names, name_offsets = pack_strings(e[3] for e in entries)
+    ntok = np.array([e[4] for e in entries], dtype=np.int16)
+    return {"mention_hash": np.array([e[0] for e in entries], dtype=np.uint32),
+            "mention_kind": np.array([e[2] for e in entries], dtype=np.int8), "mention_ntok": ntok,
+            "mention_forms": forms, "mention_form_offsets": form_offsets,
+            "mention_names": names, "mention_name_offsets": name_offsets,
+            "mention_lengths": np.unique(ntok)[::-1].copy()}
+
+def match_mentions(index, tokens):
+    # Yields (index of the match's last token, entry) for every stored form in
+    # `tokens`, by end position and longest form first.
+    grams = [(end, " ".join(tokens[end - n + 1:end + 1]))
+             for end in range(len(tokens)) for n in index["mention_lengths"].tolist() if n <= end + 1]
+    if not grams or not len(index["mention_hash"]):
+        return
+    h = np.array([zlib.crc32(g.encode("utf-8")) for _, g in grams], dtype=np.uint32)
+    lo = np.searchsorted(index["mention_hash"], h, "left")
+    hi = np.searchsorted(index["mention_hash"], h, "right")
+    for k in np.flatnonzero(hi > lo):
+        end, gram = grams[k]
+        for j in range(lo[k], hi[k]):
+            if string_at(index["mention_forms"], index["mention_form_offsets"], j) == gram:
+                yield end, j
+
+def find_mentions(text, index):
+    # [(kind, name, cue)] for every catalog name in the text, first mention wins;
+    # cue is "read", "like" or None, from the clause leading up to the mention.
+    low = text.lower().replace("\u2019", "'")
+    spans = [(mt.group(0), mt.start()) for mt in TOKEN_RE.finditer(low)]
+    found, seen = [], set()
+    for end, j in match_mentions(index, [tok for tok, _ in spans]):
+        kind, ntok = MENTION_KINDS[index["mention_kind"][j]], int(index["mention_ntok"][j])
+        name = string_at(index["mention_names"], index["mention_name_offsets"], j)
+        if (kind, name) in seen:
+            continue
+        seen.add((kind, name))
+        clause = CLAUSE_END.split(low[:spans[end - ntok + 1][1]])[-1]
+        read, like = READ_CUE.search(clause), LIKE_CUE.search(clause)
+        cue = "like" if like and (not read or like.start() > read.start()) else "read" if read else None
+        found.append((kind, name, cue))
+    return found
+
+def add_mentions(prefs, text, index):
+    have = {c.lower() for c in prefs["comps_like"]}
+    for kind, name, cue in find_mentions(text, index):
+        if name.lower() not in have:
+            prefs["comps_like"].append(name)
+            have.add(name.lower())
+        if kind == "title" and cue:
+            prefs["read_titles"].append(normalize_name(name))
+        if kind in ("title", "comp"):
+            prefs["like_titles"].append(name)
+
+# -------------------- COMPS GRAPH --------------------
+# Book-to-book links from shared comps, a shared author, or an identical genre+trope
+# shelf, summed per pair and kept as CSR arrays (top GRAPH_NEIGHBOURS per book).
+# A post naming a catalog title or comp boosts that book's neighbours.
+GRAPH_LINKS = (("comps", 2.0), ("author", 1.5), ("shelf", 1.0))
+GRAPH_MAX_POSTING = 200   # keys shared by more books than this say little and cost O(p^2)
+GRAPH_NEIGHBOURS = 20
+GRAPH_WEIGHT = 2.0        # boost for the strongest neighbour; others scale down
+
+def shelf_key(row_terms):
+    return "+".join(sorted({t.strip() for t in row_terms.lower().split("|") if t.strip()}))
+
+def build_graph(df, index):
+    n = len(df)
+    keys = {"comps": index["postings"]["comps"],
+            "author": build_postings(df["author"].map(normalize_name), r"\|"),
+            "shelf": build_postings((df["genres"] + "|" + df["tropes"]).map(shelf_key), r"\|")}
+    src, dst, wts = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)], [np.empty(0)]
+    for name, weight in GRAPH_LINKS:
+        _, indptr, rows = keys[name]
+        sizes = np.diff(indptr)
+        for i in np.flatnonzero((sizes > 1) & (sizes <= GRAPH_MAX_POSTING)):
+            r = rows[indptr[i]:indptr[i+1]].astype(np.int64)
+            src.append(np.repeat(r, len(r))); dst.append(np.tile(r, len(r)))
+            wts.append(np.full(len(r) * len(r), weight))
+    src, dst, wts = np.concatenate(src), np.concatenate(dst), np.concatenate(wts)
+    off = src != dst
+    pair, inv = np.unique(src[off] * n + dst[off], return_inverse=True)
+    weight = np.bincount(inv, weights=wts[off]) if len(pair) else np.empty(0)
+    src, dst = pair // max(n, 1), pair % max(n, 1)
+    # Strongest neighbours first within each book, then cut to GRAPH_NEIGHBOURS.
+    order = np.lexsort((dst, -weight, src))
+    src, dst, weight = src[order], dst[order], weight[order]
+    starts = np.searchsorted(src, src, side="left")
+    top = np.arange(len(src)) - starts < GRAPH_NEIGHBOURS
+    src, dst, weight = src[top], dst[top], weight[top]
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=n))]).astype(np.int64)
+    return indptr, dst.astype(np.int32), weight.astype(np.float32)
+
+def seed_rows(index, prefs):
+    # Catalog books a post names as titles, or that list a comp the post names.
+    found = [exact_rows(index, "title_norm", normalize_name(name)) for name in prefs["like_titles"]]
+    found.append(comp_rows(index, prefs["like_titles"]))
+    return np.unique(np.concatenate(found))
+
+def graph_boost(index, prefs):
+    # (rows, boost) for the seeds' neighbours, scaled so the strongest gets GRAPH_WEIGHT.
+    seeds = seed_rows(index, prefs) if prefs["like_titles"] else ()
+    if not len(seeds):
+        return np.empty(0, dtype=np.int32), np.empty(0)
+    indptr, nbr, w = index["graph_indptr"], index["graph_indices"], index["graph_weights"]
+    rows = np.concatenate([nbr[indptr[r]:indptr[r+1]] for r in seeds])
+    wts = np.concatenate([w[indptr[r]:indptr[r+1]] for r in seeds]).astype(np.float64)
+    rows, inv = np.unique(rows, return_inverse=True)
+    boost = np.bincount(inv, weights=wts)
+    mine = ~np.isin(rows, seeds)
+    rows, boost = rows[mine], boost[mine]
+    if len(boost):
+        boost = GRAPH_WEIGHT * boost / boost.max()
+    return rows, boost
+
+# -------------------- BM25 --------------------
+# Free-text relevance of a post against each book's hook_line + why_readers_might_like.
+# Built offline into CSR arrays (sorted terms, indptr, rows, impact) where impact is
+# the whole per-(term, book) BM25 contribution, so a query is slice + sum.
+BM25_K1, BM25_B = 1.2, 0.75
+BM25_WEIGHT = 2.0   # points approached as a blurb's score grows: BM25_WEIGHT * s / (s + BM25_SAT)
+BM25_SAT = 5.0      # score that earns half of BM25_WEIGHT
+BM25_MIN_TERMS = 2  # distinct post terms a blurb must share; one incidental word is not a match
+STOPWORDS = set("""a about after all also am an and any are as at be been but by can could do does
+for from get had has have he her his how i i'd i'm i've if in into is it it's its just like looking
+me more most my need no not of on one or our out please rec recs recommend recommendation
+recommendations read reading reads book books novel novels series she so some something suggest
+suggestions than that the their them then there these they this to too up us want was we were what
+when which who will with would you your""".split())
+
+def content_terms(text):
+    return [t for t in tokenize(text) if t not in STOPWORDS and len(t) > 2]
+
+def build_bm25(df):
+    docs = (df["hook_line"] + " " + df["why_readers_might_like"]).reset_index(drop=True).map(content_terms)
+    lengths = docs.map(len).to_numpy().astype(np.float64)
+    ex = docs.explode().dropna()
+    tf = pd.DataFrame({"term": ex.to_numpy(), "row": ex.index.to_numpy()}).value_counts().reset_index()
+    codes, terms = pd.factorize(tf["term"], sort=True)
+    order = np.lexsort((tf["row"].to_numpy(), codes))
+    codes, rows, counts = codes[order], tf["row"].to_numpy()[order], tf["count"].to_numpy()[order].astype(np.float64)
+    df_t = np.bincount(codes, minlength=len(terms))
+    n, avgdl = len(df), max(lengths.mean(), 1.0) if len(lengths) else 1.0
+    idf = np.log(1 + (n - df_t + 0.5) / (df_t + 0.5))
+    impact = idf[codes] * counts * (BM25_K1 + 1) / (counts + BM25_K1 * (1 - BM25_B + BM25_B * lengths[rows] / avgdl))
+    indptr = np.concatenate([[0], np.cumsum(df_t)]).astype(np.int64)
+    return np.asarray(terms, dtype=str), indptr, rows.astype(np.int32), impact.astype(np.float32)
+
+def query_terms(index, text):
+    # The post's content words that occur in the catalog text, sorted and deduplicated:
+    # part of the prefs signature, so words no book uses must not split cache keys.
+    # The embedding vocabulary covers the blurb (BM25) columns and more.
+    terms = sorted(set(content_terms(text)))
+    vocab = index["embed_terms"] if "embed_terms" in index else index["bm25_terms"]
+    if not terms or not len(vocab):
+        return []
+    at = np.minimum(np.searchsorted(vocab, terms), len(vocab) - 1)
+    return [t for t, k in zip(terms, vocab[at] == np.asarray(terms, dtype=str)) if k]
+
+def bm25_boost(index, prefs):
+    # (rows, points) for blurbs sharing at least BM25_MIN_TERMS terms with the post.
+    # Points are on an absolute scale, not relative to the best match, so weak
+    # overlap stays weak.
+    vocab = index["bm25_terms"]
+    if not prefs["text_terms"] or not len(vocab):
+        return np.empty(0, dtype=np.int32), np.empty(0)
+    indptr, rows, impact = index["bm25_indptr"], index["bm25_rows"], index["bm25_impact"]
+    at = np.minimum(np.searchsorted(vocab, prefs["text_terms"]), len(vocab) - 1)
+    at = at[vocab[at] == np.asarray(prefs["text_terms"], dtype=str)]
+    if not len(at):
+        return np.empty(0, dtype=np.int32), np.empty(0)
+    hits = np.concatenate([rows[indptr[i]:indptr[i+1]] for i in at])
+    wts = np.concatenate([impact[indptr[i]:indptr[i+1]] for i in at])
+    score = np.bincount(hits, weights=wts, minlength=index["n"])
+    shared = np.bincount(hits, minlength=index["n"])   # a term's postings hold a row once
+    hits = np.flatnonzero(shared >= BM25_MIN_TERMS).astype(np.int32)
+    return hits, BM25_WEIGHT * score[hits] / (score[hits] + BM25_SAT)
+
+# -------------------- EMBEDDINGS --------------------
+# Offline semantic matching, no hosted model: hashed tf-idf over the catalog text
+# columns, reduced by randomized truncated SVD (LSA) to EMBED_DIM float32 vectors,
+# with an IVF index (spherical k-means lists) for approximate nearest neighbours.
+# Everything is NumPy arrays, so it ships in (and is memory-mapped from) the artifact.
+EMBED_DIM = 64
+EMBED_BUCKETS = 1 << 15
+EMBED_TEXT_COLS = ["genres", "tropes", "vibes", "comps", "hook_line", "why_readers_might_like"]
+EMBED_MIN_SIM = 0.25   # cosine below this is not a match
+EMBED_WEIGHT = 2.0     # points at cosine 1.0, falling linearly to 0 at EMBED_MIN_SIM
+EMBED_MIN_TERMS = 2    # a one-word query vector is that word's direction, not a topic
+EMBED_CANDIDATES = 50
+ANN_PROBE = 8          # IVF lists searched per query
+
+def hash_buckets(terms):
+    # crc32, not hash(): bucket ids must be stable across processes.
+    return np.fromiter((zlib.crc32(t.encode()) for t in terms), dtype=np.int64, count=len(terms)) % EMBED_BUCKETS
+
+def sparse_dot(rows, cols, vals, dense, n_out):
+    # (sparse COO) @ dense, one bincount per output column.
+    out = np.zeros((n_out, dense.shape[1]))
+    for j in range(dense.shape[1]):
+        out[:, j] = np.bincount(rows, weights=vals * dense[cols, j], minlength=n_out)
+    return out
+
+def unit_rows(m):
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    return m / np.where(norms > 0, norms, 1)
+
+def build_embeddings(df, seed=0):
+    n = len(df)
+    text = df[EMBED_TEXT_COLS[0]].str.replace("|", " ", regex=False)
+    for c in EMBED_TEXT_COLS[1:]:
+        text = text + " " + df[c].str.replace("|", " ", regex=False)
+    words = [content_terms(t) for t in text]
+    docs = [hash_buckets(w) for w in words]
+    rows = np.repeat(np.arange(n), [len(d) for d in docs])
+    cols = np.concatenate(docs) if docs else np.empty(0, dtype=np.int64)
+    pair, tf = np.unique(rows * EMBED_BUCKETS + cols, return_counts=True)
+    rows, cols = pair // EMBED_BUCKETS, pair % EMBED_BUCKETS
+    idf = np.zeros(EMBED_BUCKETS)
+    dfreq = np.bincount(cols, minlength=EMBED_BUCKETS)
+    idf[dfreq > 0] = np.log((1 + n) / (1 + dfreq[dfreq > 0])) + 1
+    vals = (1 + np.log(tf)) * idf[cols]
+    vals /= np.sqrt(np.bincount(rows, weights=vals ** 2, minlength=n))[rows]
+    r = min(EMBED_DIM + 10, n, len(np.unique(cols)))
+    k = min(EMBED_DIM, r)
+    if k == 0:
+        return {}
+    # Randomized SVD with one power iteration: Q spans X's top singular directions.
+    rng = np.random.default_rng(seed)
+    q, _ = np.linalg.qr(sparse_dot(rows, cols, vals, rng.standard_normal((EMBED_BUCKETS, r)), n))
+    q, _ = np.linalg.qr(sparse_dot(rows, cols, vals, sparse_dot(cols, rows, vals, q, EMBED_BUCKETS), n))
+    _, _, vt = np.linalg.svd(sparse_dot(cols, rows, vals, q, EMBED_BUCKETS).T, full_matrices=False)
+    components = vt[:k].T.astype(np.float32)                       # buckets x k
+    vectors = unit_rows(sparse_dot(rows, cols, vals, components, n)).astype(np.float32)
+    centroids, ivf_indptr, ivf_rows = build_ivf(vectors, rng)
+    return {"embed_terms": np.asarray(sorted(set().union(*words)), dtype=str),
+            "embed_idf": idf.astype(np.float32), "embed_components": components,
+            "embed_vectors": vectors, "ivf_centroids": centroids,
+            "ivf_indptr": ivf_indptr, "ivf_rows": ivf_rows}
+
+def build_ivf(vectors, rng, iters=10):
+    n = len(vectors)
+    nlist = int(np.clip(np.sqrt(n), 1, 1024))
+    centroids = vectors[rng.choice(n, nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.concatenate([np.argmax(vectors[i:i + 65536] @ centroids.T, axis=1)
+                                 for i in range(0, n, 65536)])
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        filled = np.bincount(assign, minlength=nlist) > 0
+        centroids[filled] = unit_rows(sums[filled])
+    order = np.argsort(assign, kind="stable")
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+    return centroids.astype(np.float32), indptr, order.astype(np.int32)
+
+def embed_text_terms(index, terms):
+    buckets = hash_buckets(terms)
+    vals = index["embed_idf"][buckets].astype(np.float64)
+    vec = vals @ index["embed_components"][buckets]
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else None
+
+def embed_boost(index, prefs):
+    # (rows, points) for the EMBED_CANDIDATES nearest books found by probing the
+    # ANN_PROBE closest IVF lists.
+    if len(prefs["text_terms"]) < EMBED_MIN_TERMS or "embed_vectors" not in index:
+        return np.empty(0, dtype=np.int32), np.empty(0)
+    vec = embed_text_terms(index, prefs["text_terms"])
+    if vec is None:
+        return np.empty(0, dtype=np.int32), np.empty(0)
+    centroids, indptr, lists = index["ivf_centroids"], index["ivf_indptr"], index["ivf_rows"]
+    probe = np.argsort(-(centroids @ vec))[:ANN_PROBE]
+    rows = np.concatenate([lists[indptr[c]:indptr[c + 1]] for c in probe])
+    sims = index["embed_vectors"][rows] @ vec
+    if len(rows) > EMBED_CANDIDATES:
+        top = np.argpartition(-sims, EMBED_CANDIDATES - 1)[:EMBED_CANDIDATES]
+        rows, sims = rows[top], sims[top]
+    good = sims >= EMBED_MIN_SIM
+    order = np.argsort(rows[good])
+    points = EMBED_WEIGHT * (sims[good][order] - EMBED_MIN_SIM) / (1 - EMBED_MIN_SIM)
+    return rows[good][order].astype(np.int32), points
+
+def soft_boosts(index, prefs):
+    # Graded signals added on top of the score_row weights: [(rows, points), ...].
+    boosts = (graph_boost(index, prefs), bm25_boost(index, prefs), embed_boost(index, prefs))
+    return [b for b in boosts if len(b[0])]
+
 # -------------------- SCORING --------------------
 def contains_any(cell, terms):
     c = str(cell).lower()
     return any(t.lower() in c for t in terms)
 
-def score_row(row, prefs):
+def comps_any(cell, names):
+    return not {normalize_name(n) for n in names}.isdisjoint(normalize_comps(cell).split("|"))
+
+def score_row(row, prefs, strict=False):
+    # strict: the pages / hard_nopes penalties are left to keep_mask.
     s = 0
     if prefs["genres_like"]: s += 3 * contains_any(row["genres"], prefs["genres_like"])
     if prefs["tropes"]:      s += 2 * contains_any(row["tropes"], prefs["tropes"])
@@ -123,21 +832,298 @@ def score_row(row, prefs):
     if prefs["ku"] and bool(row["ku"]): s += 1
     if prefs["audio"] and bool(row["audio"]): s += 1
     try:
-        if prefs["max_pages"] and int(row["pages"]) > prefs["max_pages"]:
+        if prefs["max_pages"] and not strict and int(row["pages"]) > prefs["max_pages"]:
             s -= 2
     except Exception:
         pass
-    if prefs["hard_nopes"] and contains_any(row["content_notes"], prefs["hard_nopes"]):
+    if prefs["hard_nopes"] and not strict and contains_any(row["content_notes"], prefs["hard_nopes"]):
         s -= 4
-    if prefs["comps_like"] and contains_any(row["comps"], prefs["comps_like"]):
+    if prefs["comps_like"] and comps_any(row["comps"], prefs["comps_like"]):
         s += 2
     return s
 
-def pick_books(df, prefs, k=4):
-    scored = df.copy()
-    scored["score"] = scored.apply(lambda r: score_row(r, prefs), axis=1)
-    best = scored.sort_values("score", ascending=False).head(k)
-    return best[best["score"] > 0]
+def contains_any_mask(col, terms):
+    # Vectorized contains_any over an already-lowercased column.
+    mask = np.zeros(len(col), dtype=bool)
+    for t in terms:
+        mask |= col.str.contains(t.lower(), regex=False).to_numpy(dtype=bool)
+    return mask
+
+def comps_any_mask(col, names):
+    # Vectorized comps_any over a comps_norm column.
+    items = col.str.split("|").explode()
+    hit = items.isin({normalize_name(n) for n in names})
+    return hit.groupby(level=0).any().reindex(col.index, fill_value=False).to_numpy(dtype=bool)
+
+# Same weights as score_row, added up as NumPy masks over the whole catalog in one pass.
+def score_frame(df, prefs, strict=False):
+    s = np.zeros(len(df), dtype=np.int64)
+    if prefs["genres_like"]: s += 3 * contains_any_mask(df["genres_lc"], prefs["genres_like"])
+    if prefs["tropes"]:      s += 2 * contains_any_mask(df["tropes_lc"], prefs["tropes"])
+    if prefs["vibes"]:       s += 1 * contains_any_mask(df["vibes_lc"], prefs["vibes"])
+    if prefs["heat"]:        s += contains_any_mask(df["heat_lc"], [prefs["heat"]])
+    if prefs["ku"]:          s += df["ku"].to_numpy(dtype=bool)
+    if prefs["audio"]:       s += df["audio"].to_numpy(dtype=bool)
+    if prefs["max_pages"] and not strict:
+        s -= 2 * (df["pages"].to_numpy() > prefs["max_pages"])
+    if prefs["hard_nopes"] and not strict:
+        s -= 4 * contains_any_mask(df["content_notes_lc"], prefs["hard_nopes"])
+    if prefs["comps_like"]:
+        s += 2 * comps_any_mask(df["comps_norm"], prefs["comps_like"])
+    return s
+
+def keep_mask(index, prefs):
+    # Books a post rules out before scoring, as a keep-mask over the catalog
+    # (None = keep all): ones the poster has already read, and under
+    # STRICT_FILTERS the hard_nopes / max_pages violations.
+    strict = STRICT_FILTERS and (prefs["max_pages"] or prefs["hard_nopes"])
+    if not strict and not prefs["read_titles"]:
+        return None
+    keep = np.ones(index["n"], dtype=bool)
+    for title in prefs["read_titles"]:
+        keep[exact_rows(index, "title_norm", title)] = False
+    if STRICT_FILTERS and prefs["max_pages"]:
+        cut = np.searchsorted(index["pages_sorted"], prefs["max_pages"], side="right")
+        keep[index["pages_order"][cut:]] = False
+    if STRICT_FILTERS and prefs["hard_nopes"]:
+        keep[rows_any(index, "content_notes_norm", prefs["hard_nopes"])] = False
+    return keep
+
+# Same weights again, but only over the union of rows the index says can score > 0.
+def score_candidates(index, prefs):
+    gains = []
+    if prefs["genres_like"]: gains.append((3, rows_any(index, "genres", prefs["genres_like"])))
+    if prefs["tropes"]:      gains.append((2, rows_any(index, "tropes", prefs["tropes"])))
+    if prefs["vibes"]:       gains.append((1, rows_any(index, "vibes", prefs["vibes"])))
+    if prefs["heat"]:        gains.append((1, rows_any(index, "heat", [prefs["heat"]])))
+    if prefs["ku"]:          gains.append((1, index["ku_rows"]))
+    if prefs["audio"]:       gains.append((1, index["audio_rows"]))
+    if prefs["comps_like"]:  gains.append((2, comp_rows(index, prefs["comps_like"])))
+    boosts = soft_boosts(index, prefs)
+    if not gains and not boosts:
+        return np.empty(0, dtype=np.int32), np.empty(0)
+    cand = np.unique(np.concatenate([r for _, r in gains] + [r for r, _ in boosts]))
+    keep = keep_mask(index, prefs)
+    if keep is not None:
+        cand = cand[keep[cand]]
+    s = np.zeros(len(cand))
+    for w, r in gains:
+        s += w * np.isin(cand, r, assume_unique=True)
+    for rows, points in boosts:
+        at = np.minimum(np.searchsorted(rows, cand), len(rows) - 1)
+        hit = rows[at] == cand
+        s[hit] += points[at[hit]]
+    # In strict mode the filters above replace these penalties.
+    if prefs["max_pages"] and not STRICT_FILTERS:
+        s -= 2 * (index["pages"][cand] > prefs["max_pages"])
+    if prefs["hard_nopes"] and not STRICT_FILTERS:
+        s -= 4 * np.isin(cand, rows_any(index, "content_notes", prefs["hard_nopes"]), assume_unique=True)
+    return cand, s
+
+def top_k(scores, rows, years, k):
+    # Positions of the best k positive scores in O(n): argpartition finds the k-th
+    # best value, and only rows at or above it get sorted. Ties go to the newer book,
+    # then to catalog order, so every backend returns the same picks.
+    pos = np.flatnonzero(scores > 0)
+    if len(pos) > k:
+        kth = -np.partition(-scores[pos], k - 1)[k - 1]
+        pos = pos[scores[pos] >= kth]
+    order = np.lexsort((rows[pos], -years[pos], -scores[pos]))
+    return pos[order[:k]]
+
+def picks_frame(df, rows, scores, years, k, index=None):
+    if index is not None and "feature_bits" in index and MMR_LAMBDA < 1:
+        sel = mmr_rerank(index, rows, scores, top_k(scores, rows, years, MMR_POOL), k)
+    else:
+        sel = top_k(scores, rows, years, k)
+    best = df.iloc[rows[sel]].copy()
+    best["score"] = scores[sel]
+    return best
+
+# -------------------- DIVERSITY --------------------
+# Maximal-marginal-relevance re-rank of the top MMR_POOL picks so one author or one
+# shelf doesn't take every slot. Each book carries a FEATURE_BITS-bit set of its
+# hashed genre and comp terms plus an author id; similarity is
+# 0.5 * same-author + 0.5 * Jaccard(bits), a few uint8 ops per step.
+MMR_POOL = 50
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))   # 1.0 = pure relevance order
+FEATURE_BITS = 256
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def build_feature_bits(df, index):
+    bits = np.zeros((len(df), FEATURE_BITS // 8), dtype=np.uint8)
+    for col in ("genres", "comps"):
+        terms, indptr, rows = index["postings"][col]
+        bit = np.array([zlib.crc32(f"{col}:{t}".encode()) % FEATURE_BITS for t in terms], dtype=np.int64)
+        per_row = np.repeat(bit, np.diff(indptr))
+        np.bitwise_or.at(bits, (rows, per_row // 8), (1 << (per_row % 8)).astype(np.uint8))
+    author_ids, _ = pd.factorize(df["author"].map(normalize_name))
+    return bits, author_ids.astype(np.int32)
+
+def mmr_rerank(index, rows, scores, pool, k):
+    # Greedy MMR over positions `pool` (best first); returns up to k positions.
+    if len(pool) <= 1:
+        return pool[:k]
+    books = rows[pool]
+    bits, authors = index["feature_bits"][books], index["author_ids"][books]
+    ones = POPCOUNT[bits].sum(axis=1).astype(np.float64)
+    rel = scores[pool] / scores[pool].max()
+    max_sim = np.zeros(len(pool))
+    chosen = [0]
+    taken = np.zeros(len(pool), dtype=bool)
+    while True:
+        last = chosen[-1]
+        taken[last] = True
+        both = POPCOUNT[bits & bits[last]].sum(axis=1)
+        union = ones + ones[last] - both
+        jaccard = np.divide(both, union, out=np.zeros(len(pool)), where=union > 0)
+        max_sim = np.maximum(max_sim, 0.5 * (authors == authors[last]) + 0.5 * jaccard)
+        if len(chosen) >= k or taken.all():
+            break
+        gain = np.where(taken, -np.inf, MMR_LAMBDA * rel - (1 - MMR_LAMBDA) * max_sim)
+        chosen.append(int(np.argmax(gain)))
+    return pool[chosen]
+
+# -------------------- PICK CACHE --------------------
+# Many posts boil down to the same prefs ("cozy mystery, KU"). Results are cached
+# under a canonical signature of the prefs plus the catalog version, so a new
+# catalog (different source hash) never serves stale picks.
+class PickCache:
+    def __init__(self, size):
+        self.size, self.version = size, None
+        self.entries = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, version, key):
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+PICK_CACHE = PickCache(PICK_CACHE_SIZE)
+
+def prefs_signature(prefs):
+    # Order and case of list entries don't change the picks, so they don't change the key.
+    return tuple(sorted((k, tuple(sorted({str(x).lower() for x in v})) if isinstance(v, list) else v)
+                        for k, v in prefs.items()))
+
+def pick_key(prefs, k):
+    return (prefs_signature(prefs), k, SCORING_MODE, STRICT_FILTERS, MMR_LAMBDA)
+
+def pick_books(df, prefs, k=4, index=None):
+    if index is None or PICK_CACHE_SIZE <= 0:
+        return score_picks(df, prefs, k, index)
+    key = pick_key(prefs, k)
+    picks = PICK_CACHE.get(index["version"], key)
+    if picks is None:
+        picks = score_picks(df, prefs, k, index)
+        PICK_CACHE.put(key, picks)
+    return picks
+
+def score_picks(df, prefs, k=4, index=None):
+    if index is not None and SCORING_MODE != "rowwise":
+        cand, s = score_candidates(index, prefs)
+        return picks_frame(df, cand, s, index["year"][cand], k, index)
+    # Without an index there are no keep-mask filters, so the penalties always apply.
+    strict = STRICT_FILTERS and index is not None
+    if SCORING_MODE == "rowwise":
+        s = df.apply(lambda r: score_row(r, prefs, strict), axis=1).to_numpy(dtype=np.float64)
+    else:
+        s = score_frame(df, prefs, strict).astype(np.float64)
+    if index is not None:
+        for rows, points in soft_boosts(index, prefs):
+            s[rows] += points
+        keep = keep_mask(index, prefs)
+        if keep is not None:
+            s = np.where(keep, s, 0)
+    return picks_frame(df, np.arange(len(df)), s, book_years(df), k, index)
+
+# -------------------- BATCH SCORING --------------------
+# N posts x M books in one pass: each post's prefs become a sparse weighted vector
+# over (column, term) features, the catalog is the sparse book x feature matrix
+# given by the index postings, and the product is taken in the OR/AND semiring per
+# preference group (contains_any counts a group once, however many terms hit).
+# Only the product's nonzeros are touched; the dense part is the per-block score
+# matrix itself, which BATCH_CELLS bounds.
+BATCH_CELLS = 1 << 22   # max posts x books scored at once (float64: 32 MB)
+
+def batch_features(index, prefs):
+    # [(weight, [postings...]), ...] for one post; mirrors score_candidates.
+    groups = []
+    if prefs["genres_like"]: groups.append((3, [term_rows(index, "genres", t.lower()) for t in prefs["genres_like"]]))
+    if prefs["tropes"]:      groups.append((2, [term_rows(index, "tropes", t.lower()) for t in prefs["tropes"]]))
+    if prefs["vibes"]:       groups.append((1, [term_rows(index, "vibes", t.lower()) for t in prefs["vibes"]]))
+    if prefs["heat"]:        groups.append((1, [term_rows(index, "heat", prefs["heat"])]))
+    if prefs["ku"]:          groups.append((1, [index["ku_rows"]]))
+    if prefs["audio"]:       groups.append((1, [index["audio_rows"]]))
+    if prefs["comps_like"]:  groups.append((2, [comp_rows(index, prefs["comps_like"])]))
+    if prefs["hard_nopes"] and not STRICT_FILTERS:
+        groups.append((-4, [term_rows(index, "content_notes", t.lower()) for t in prefs["hard_nopes"]]))
+    return groups
+
+def score_batch(index, prefs_list):
+    # Yields one score vector per post, in order. Posts are scored a block at a
+    # time, so only one block's matrix is alive however many posts come in.
+    n = index["n"]
+    chunk = max(1, BATCH_CELLS // max(n, 1))
+    for lo in range(0, len(prefs_list), chunk):
+        block = prefs_list[lo:lo + chunk]
+        scores = np.zeros((len(block), n))
+        # Collect the product's nonzeros per (weight, group slot); a slot holds one
+        # group per post, so one scatter covers every post in the block.
+        slots = {}
+        for i, prefs in enumerate(block):
+            keep = keep_mask(index, prefs)
+            for g, (w, postings) in enumerate(batch_features(index, prefs)):
+                post_ids, rows = slots.setdefault((w, g), ([], []))
+                for r in postings:
+                    if keep is not None:
+                        r = r[keep[r]]
+                    post_ids.append(np.full(len(r), i, dtype=np.int64))
+                    rows.append(r)
+        for (w, _), (post_ids, rows) in slots.items():
+            # OR within the group: a book hit by several terms counts once.
+            cells = np.unique(np.concatenate(post_ids) * n + np.concatenate(rows))
+            scores.flat[cells] += w
+        for i, prefs in enumerate(block):
+            keep = keep_mask(index, prefs)
+            for rows, points in soft_boosts(index, prefs):
+                if keep is not None:
+                    rows, points = rows[keep[rows]], points[keep[rows]]
+                scores[i, rows] += points
+        max_pages = np.array([p["max_pages"] or 0 for p in block])
+        capped = max_pages > 0
+        if capped.any() and not STRICT_FILTERS:
+            scores[capped] -= 2 * (index["pages"][None, :] > max_pages[capped, None])
+        yield from scores
+
+def pick_books_batch(df, prefs_list, k=4, index=None):
+    if index is None or SCORING_MODE == "rowwise":
+        return [pick_books(df, prefs, k=k, index=index) for prefs in prefs_list]
+    # Only cache misses (deduplicated by signature) go through the batch product.
+    keys = [pick_key(prefs, k) for prefs in prefs_list]
+    picks = {key: PICK_CACHE.get(index["version"], key) for key in dict.fromkeys(keys)}
+    PICK_CACHE.hits += len(keys) - len(picks)   # repeats within this batch
+    todo = {key: prefs for key, prefs in zip(keys, prefs_list) if picks[key] is None}
+    rows = np.arange(index["n"])
+    # score_batch is lazy: each block's picks are taken before the next block is scored.
+    for key, s in zip(todo, score_batch(index, list(todo.values()))):
+        picks[key] = picks_frame(df, rows, s, index["year"], k, index)
+        PICK_CACHE.put(key, picks[key])
+    return [picks[key] for key in keys]
 
 # -------------------- RENDER --------------------
 def summarize_prefs(prefs):
@@ -160,16 +1146,92 @@ def render_reply(prefs, picks):
     lines.append("\nWant KU-only or audio-first options? I can swap.")
     return "\n".join(lines)
 
+# -------------------- STATE --------------------
+# Local SQLite (WAL) store of what the bot has already done, so guardrails can be
+# answered without an API round trip.
+STATE_RETENTION_DAYS = 30
+
+def open_state(path=STATE_DB):
+    db = sqlite3.connect(path, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE IF NOT EXISTS replied (post_id TEXT PRIMARY KEY, sub TEXT, replied_utc REAL)")
+    db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS cursors (listing TEXT PRIMARY KEY, fullname TEXT, created_utc REAL)")
+    db.execute("CREATE TABLE IF NOT EXISTS backoff (scope TEXT PRIMARY KEY, until_utc REAL, failures INTEGER, reason TEXT)")
+    db.execute("CREATE TABLE IF NOT EXISTS outbox (post_id TEXT PRIMARY KEY, sub TEXT, body TEXT, status TEXT, "
+               "attempts INTEGER, next_attempt_utc REAL, last_error TEXT, created_utc REAL)")
+    cutoff = time.time() - STATE_RETENTION_DAYS * 86400
+    db.execute("DELETE FROM replied WHERE replied_utc < ?", (cutoff,))
+    db.execute("DELETE FROM outbox WHERE status != 'pending' AND created_utc < ?", (cutoff,))
+    return db
+
+def mark_replied(db, post_id, sub="", when=None):
+    db.execute("INSERT OR IGNORE INTO replied VALUES (?, ?, ?)", (post_id, sub, when or time.time()))
+
+def was_replied(db, post_id):
+    return db.execute("SELECT 1 FROM replied WHERE post_id = ?", (post_id,)).fetchone() is not None
+
+def get_meta(db, key, default=None):
+    row = db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def set_meta(db, key, value):
+    db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, str(value)))
+
+def get_cursor(db, listing):
+    # Newest (fullname, created_utc) fully processed for a listing. Cursors past the
+    # age window are dropped: nothing older is a candidate anyway.
+    row = db.execute("SELECT fullname, created_utc FROM cursors WHERE listing = ?", (listing,)).fetchone()
+    if row and row[1] >= time.time() - MAX_POST_AGE_HOURS * 3600:
+        return row
+    return None, 0.0
+
+def set_cursor(db, listing, fullname, created_utc):
+    db.execute("INSERT OR REPLACE INTO cursors VALUES (?, ?, ?)", (listing, fullname, created_utc))
+
+def sync_replied_from_history(reddit, me, db):
+    # One newest-first pass over the bot's own comments, back to the age window or
+    # the previous sync, whichever is newer. Returns False if the listing failed.
+    since = max(time.time() - MAX_POST_AGE_HOURS * 3600, float(get_meta(db, "history_synced_utc", 0)))
+    newest, found = None, 0
+    try:
+        for c in reddit.redditor(me).comments.new(limit=None):
+            if newest is None:
+                newest = c.created_utc
+            if c.created_utc <= since:
+                break
+            if c.link_id.startswith("t3_"):
+                mark_replied(db, c.link_id[3:], str(c.subreddit), c.created_utc)
+                found += 1
+    except Exception as e:
+        print(f"⚠️ Could not sync reply history: {e}")
+        return False
+    if newest is not None:
+        set_meta(db, "history_synced_utc", max(newest, since))
+    print(f"Synced {found} replied posts from comment history.")
+    return True
+
 # -------------------- GUARDRAILS --------------------
 def is_recent(post):
     age_hours = (datetime.now(timezone.utc) - datetime.fromtimestamp(post.created_utc, tz=timezone.utc)).total_seconds()/3600
     return age_hours <= MAX_POST_AGE_HOURS
 
-def already_replied(post, my_username):
+def already_replied(post, my_username, db=None, verify=VERIFY_REPLIED):
+    if db is not None and was_replied(db, post.id):
+        return True
+    if not verify:
+        return False
+    if not API_USAGE.can_afford():
+        # The walk is optional (the local index already said no); keep the quota for replies.
+        API_USAGE.skipped_walks += 1
+        return False
     try:
         post.comments.replace_more(limit=0)
         for c in post.comments.list():
             if str(c.author).lower() == my_username.lower():
+                if db is not None:
+                    mark_replied(db, post.id, str(post.subreddit), c.created_utc)
                 return True
     except Exception:
         pass
@@ -179,52 +1241,739 @@ def looks_like_request(text):
     t = text.lower()
     return bool(re.search(r"\b(rec|recommend|suggest|looking for|what should i read)\b", t))
 
+# -------------------- BACKOFF --------------------
+RETRY_IN_RE = re.compile(r"(\d+)\s*(second|minute|hour)s?", re.I)
+UNIT_SECONDS = {"second": 1, "minute": 60, "hour": 3600}
+
+def ratelimit_seconds(exc):
+    # Longest wait named by the exception's RATELIMIT items ("try again in 7 minutes"),
+    # or None if it has none. Reddit rounds down, so one unit of slack is added.
+    waits = []
+    for item in getattr(exc, "items", []):
+        if item.error_type == "RATELIMIT":
+            m = RETRY_IN_RE.search(item.message or "")
+            waits.append((int(m.group(1)) + 1) * UNIT_SECONDS[m.group(2).lower()] if m else BACKOFF_BASE_SECONDS)
+    return max(waits) if waits else None
+
+class Backoff:
+    """Retry-after deadlines for the account and for each sub, kept in the state DB
+    so the next run doesn't walk straight back into a limit.
+
+    RATELIMIT errors name their wait and apply to the sub being replied in (Reddit's
+    per-sub throttle for low-karma accounts); 5xx, 429 and network errors apply to
+    the account and back off exponentially with jitter.
+    """
+
+    def __init__(self, db, clock=time.time):
+        self.db, self.clock = db, clock
+        self.state = {scope: (until, failures) for scope, until, failures in
+                      db.execute("SELECT scope, until_utc, failures FROM backoff")}
+
+    def _set(self, scope, until, failures, reason):
+        self.state[scope] = (until, failures)
+        self.db.execute("INSERT OR REPLACE INTO backoff VALUES (?, ?, ?, ?)", (scope, until, failures, reason))
+
+    def wait(self, sub=None):
+        # Seconds until a reply may be attempted (account-wide when sub is None).
+        scopes = ["account"] + ([f"sub:{sub}"] if sub else [])
+        now = self.clock()
+        return max([0.0] + [self.state[s][0] - now for s in scopes if s in self.state])
+
+    def ratelimited(self, sub, seconds, reason=""):
+        _, failures = self.state.get(f"sub:{sub}", (0, 0))
+        self._set(f"sub:{sub}", self.clock() + seconds, failures + 1, reason)
+        return seconds
+
+    def server_error(self, reason="", retry_after=None):
+        _, failures = self.state.get("account", (0, 0))
+        delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** failures)
+        delay = random.uniform(delay / 2, delay)   # jitter: don't retry in lockstep
+        if retry_after:
+            delay = max(delay, float(retry_after))
+        self._set("account", self.clock() + delay, failures + 1, reason)
+        return delay
+
+    def succeeded(self, sub):
+        for scope in ("account", f"sub:{sub}"):
+            if self.state.pop(scope, None) is not None:
+                self.db.execute("DELETE FROM backoff WHERE scope = ?", (scope,))
+
+# -------------------- OUTBOX --------------------
+class Outbox:
+    """Rendered replies, written before they are sent, so a run that times out or
+    crashes loses no finished work. Rows go pending -> sent | failed | expired.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def put(self, post_id, sub, body):
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO outbox VALUES (?, ?, ?, 'pending', 0, ?, '', ?)",
+                        (post_id, sub, body, now, now))
+
+    def update(self, post_id, status, attempts, next_attempt_utc, error=""):
+        self.db.execute("UPDATE outbox SET status = ?, attempts = ?, next_attempt_utc = ?, last_error = ? "
+                        "WHERE post_id = ?", (status, attempts, next_attempt_utc, error, post_id))
+
+    def has(self, post_id):
+        return self.db.execute("SELECT 1 FROM outbox WHERE post_id = ?", (post_id,)).fetchone() is not None
+
+    def due(self, horizon):
+        # Pending rows whose next attempt falls before `horizon`, oldest first. Rows past
+        # the age window or the attempt limit are closed out, and rows whose reply is
+        # already in the replied index (a crash between send and update) are marked sent.
+        now = time.time()
+        self.db.execute("UPDATE outbox SET status = 'expired' WHERE status = 'pending' AND created_utc < ?",
+                        (now - MAX_POST_AGE_HOURS * 3600,))
+        self.db.execute("UPDATE outbox SET status = 'failed' WHERE status = 'pending' AND attempts >= ?",
+                        (MAX_SEND_ATTEMPTS,))
+        self.db.execute("UPDATE outbox SET status = 'sent' WHERE status = 'pending' "
+                        "AND post_id IN (SELECT post_id FROM replied)")
+        return self.db.execute("SELECT post_id, sub, body, attempts, created_utc FROM outbox "
+                               "WHERE status = 'pending' AND next_attempt_utc <= ? ORDER BY created_utc",
+                               (horizon,)).fetchall()
+
+# -------------------- REPLY SCHEDULER --------------------
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate, self.capacity = rate, burst   # tokens per second, max tokens
+        self.tokens, self.stamp = float(burst), now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait(self, now):
+        # Seconds until one token is available (0 if one is available now).
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+class ReplyScheduler:
+    """Queues rendered replies and sends them as the account and per-sub buckets allow.
+
+    pump() never blocks, so scanning and scoring carry on while replies wait for
+    their slot; drain() is the only place that sleeps. `hold(sub)` gives the seconds
+    a sub (or, for None, the account) is backing off. send() returns (ok, error);
+    ok None means "retry later" and re-queues the reply, up to MAX_SEND_ATTEMPTS
+    sends. With an outbox, every reply is stored on submit and its outcome recorded.
+
+    Finished replies are counted; the items themselves are kept in sent/failed only
+    with history=True (a cron run needs them; the daemon would grow without bound).
+    """
+
+    def __init__(self, send, clock=time.monotonic, hold=lambda sub: 0.0, outbox=None, history=False):
+        self.send, self.clock, self.hold, self.outbox = send, clock, hold, outbox
+        self.bucket = TokenBucket(REPLY_RATE_PER_MIN / 60, REPLY_BURST, clock())
+        self.sub_buckets = {}
+        self.history = history
+        self.queue, self.sent, self.failed = [], [], []
+        self.sent_count = self.failed_count = 0
+        self.attempts = {}   # post id -> sends so far, for queued replies only
+
+    def _sub_bucket(self, sub):
+        if sub not in self.sub_buckets:
+            self.sub_buckets[sub] = TokenBucket(SUB_REPLY_RATE_PER_HOUR / 3600, SUB_REPLY_BURST, self.clock())
+        return self.sub_buckets[sub]
+
+    def submit(self, post, reply, sub):
+        if self.outbox is not None:
+            self.outbox.put(post.id, sub, reply)
+        self.queue.append((post, reply, sub))
+
+    def resume(self, post, reply, sub, attempts):
+        # Re-queue a reply from the outbox, keeping its attempt count.
+        self.attempts[post.id] = attempts
+        self.queue.append((post, reply, sub))
+
+    def next_wait(self):
+        # Seconds until the next queued reply may go out.
+        now = self.clock()
+        if not self.queue:
+            return None
+        return max(self.bucket.wait(now), min(max(self._sub_bucket(sub).wait(now), self.hold(sub))
+                                              for _, _, sub in self.queue))
+
+    def pump(self):
+        sent = 0
+        for item in list(self.queue):
+            now = self.clock()
+            if self.bucket.wait(now) > 0 or self.hold(None) > 0:
+                break
+            post, reply, sub = item
+            if self._sub_bucket(sub).wait(now) > 0 or self.hold(sub) > 0:
+                continue   # this sub is over its limit; later items for other subs may go
+            self.bucket.take(now)
+            self._sub_bucket(sub).take(now)
+            self.queue.remove(item)
+            attempts = self.attempts[post.id] = self.attempts.get(post.id, 0) + 1
+            ok, error = self.send(post, reply)
+            if ok is None and attempts < MAX_SEND_ATTEMPTS:
+                self.queue.append(item)
+                status = "pending"
+            else:
+                del self.attempts[post.id]
+                status = "sent" if ok else "failed"
+                if ok:
+                    self.sent_count += 1
+                    sent += 1
+                else:
+                    self.failed_count += 1
+                if self.history:
+                    (self.sent if ok else self.failed).append(item)
+            if self.outbox is not None:
+                self.outbox.update(post.id, status, attempts, time.time() + self.hold(sub), error)
+        return sent
+
+    def drain(self, deadline=None):
+        while self.queue:
+            wait = self.next_wait()
+            if deadline is not None and time.time() + wait > deadline:
+                print(f"⚠️ Run budget reached with {len(self.queue)} replies unsent.")
+                break
+            if wait > 0:
+                print(f"Next reply slot in {wait:.0f}s…")
+                time.sleep(wait)
+            self.pump()
+
+# -------------------- LATENCY --------------------
+HIST_SUB_BITS = 5   # 16 buckets per power of two: quantiles within ~6%
+QUANTILES = (0.5, 0.95, 0.99)
+
+class Histogram:
+    """Log-linear (HDR-style) histogram of nanosecond durations.
+
+    Values below 2**HIST_SUB_BITS get a bucket each; above that every power of two
+    is split into equal buckets, so the relative error is bounded at any scale
+    and record() is a few integer ops.
+    """
+
+    def __init__(self):
+        self.counts, self.count, self.total, self.max = {}, 0, 0, 0
+
+    @staticmethod
+    def bucket(v):
+        e = max(v.bit_length() - HIST_SUB_BITS, 0)
+        return (e << (HIST_SUB_BITS - 1)) + (v >> e)
+
+    @staticmethod
+    def bucket_high(i):
+        # Largest value that lands in bucket i.
+        e = max((i >> (HIST_SUB_BITS - 1)) - 1, 0)
+        return ((i - (e << (HIST_SUB_BITS - 1)) + 1) << e) - 1
+
+    def record(self, ns):
+        ns = max(int(ns), 0)
+        i = self.bucket(ns)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += ns
+        self.max = max(self.max, ns)
+
+    def merge(self, other):
+        for i, c in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + c
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        rank, seen = max(int(np.ceil(q * self.count)), 1), 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(self.bucket_high(i), self.max)
+        return self.max
+
+    def summary(self):
+        out = {"count": self.count, "sum_ms": self.total / 1e6, "max_ms": self.max / 1e6}
+        for q in QUANTILES:
+            out[f"p{round(q * 100)}_ms"] = self.quantile(q) / 1e6
+        return out
+
+class StageTimers:
+    """Histograms keyed by (stage, subreddit)."""
+
+    def __init__(self):
+        self.hists = {}
+
+    def record(self, stage, sub, ns):
+        hist = self.hists.get((stage, sub))
+        if hist is None:
+            hist = self.hists[(stage, sub)] = Histogram()
+        hist.record(ns)
+
+    def by_stage(self):
+        merged = {}
+        for (stage, _), hist in sorted(self.hists.items()):
+            merged.setdefault(stage, Histogram()).merge(hist)
+        return merged
+
+    def prometheus(self):
+        lines = []
+        series = [("kubookrecs_stage_seconds", "Time spent per bot stage, all subreddits.",
+                   [({"stage": st}, h) for st, h in self.by_stage().items()]),
+                  ("kubookrecs_sub_stage_seconds", "Time spent per bot stage and subreddit.",
+                   [({"stage": st, "sub": sub}, h) for (st, sub), h in sorted(self.hists.items())])]
+        for name, help_text, hists in series:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} summary"]
+            for labels, hist in hists:
+                lab = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                for q in QUANTILES:
+                    lines.append(f'{name}{{{lab},quantile="{q}"}} {hist.quantile(q) / 1e9:.9f}')
+                lines.append(f"{name}_sum{{{lab}}} {hist.total / 1e9:.9f}")
+                lines.append(f"{name}_count{{{lab}}} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        subs = {}
+        for (stage, sub), hist in sorted(self.hists.items()):
+            subs.setdefault(sub, {})[stage] = hist.summary()
+        return {"stages": {st: h.summary() for st, h in self.by_stage().items()}, "subs": subs}
+
+    def report(self):
+        parts = [f"{st} {h.quantile(.5) / 1e6:.1f}/{h.quantile(.95) / 1e6:.1f}/{h.quantile(.99) / 1e6:.1f}"
+                 for st, h in self.by_stage().items()]
+        if parts:
+            print("Latency p50/p95/p99 ms: " + ", ".join(parts))
+
+LATENCY = StageTimers()
+
+def write_metrics(prom_path=METRICS_PROM, json_path=METRICS_JSON):
+    if prom_path:
+        write_atomic(prom_path, LATENCY.prometheus() + API_USAGE.prometheus())
+    if json_path:
+        doc = {"generated_utc": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+               **LATENCY.summary(), "api": API_USAGE.summary()}
+        write_atomic(json_path, json.dumps(doc, indent=2) + "\n")
+
+def write_atomic(path, text):
+    # Textfile collectors may read at any moment; never let them see a half-written file.
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+def timed_fetch(listing, posts):
+    # Listings fetch their pages lazily while iterated, so time each step of the
+    # iteration and record the total once the caller is done with the listing.
+    ns, it = 0, iter(posts)
+    try:
+        while True:
+            t0 = time.perf_counter_ns()
+            try:
+                with api_stage("fetch"):
+                    post = next(it)
+            except StopIteration:
+                return
+            finally:
+                ns += time.perf_counter_ns() - t0
+            yield post
+    finally:
+        LATENCY.record("fetch", listing, ns)
+
+# -------------------- RUN LOG --------------------
+STAGES = ("screen", "verify", "extract", "score", "render", "reply")
+LOG_FIELDS = (["logged_utc", "post_id", "sub", "age_hours", "decision", "reason",
+               "prefs", "pick_ids", "pick_scores"] + [f"{stage}_ms" for stage in STAGES])
+
+def post_record(post, sub=None, created_utc=None):
+    # What the run log keeps about one post while it moves through the stages.
+    # Outbox replies pass sub and created_utc so the post needn't be fetched.
+    sub = sub or post.subreddit.display_name.lower()
+    created_utc = post.created_utc if created_utc is None else created_utc
+    return {"post_id": post.id, "sub": sub, "age_hours": (time.time() - created_utc) / 3600,
+            "decision": "skipped", "reason": "", "prefs": None, "picks": None, "timings": {}}
+
+def add_timing(rec, stage, ns):
+    rec["timings"][stage] = rec["timings"].get(stage, 0) + ns
+    LATENCY.record(stage, rec["sub"], ns)
+
+@contextmanager
+def timed(rec, stage):
+    t0 = time.perf_counter_ns()
+    try:
+        with api_stage(stage):
+            yield
+    finally:
+        if rec is not None:
+            add_timing(rec, stage, time.perf_counter_ns() - t0)
+
+class RunLog:
+    """Appends post records to LOG_PATH as CSV.
+
+    Rows are buffered and written every LOG_FLUSH_ROWS rows and at exit, so the
+    hot path never waits on the file and a crashed run still leaves its rows.
+    """
+
+    def __init__(self, path=LOG_PATH, flush_rows=LOG_FLUSH_ROWS):
+        self.path, self.flush_rows, self.rows = path, flush_rows, []
+        if path:
+            atexit.register(self.flush)
+
+    def write(self, rec):
+        if not self.path:
+            return
+        picks = rec["picks"]
+        row = {
+            "logged_utc": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "post_id": rec["post_id"], "sub": rec["sub"], "age_hours": f"{rec['age_hours']:.2f}",
+            "decision": rec["decision"], "reason": rec["reason"],
+            "prefs": json.dumps(rec["prefs"], separators=(",", ":")) if rec["prefs"] else "",
+            "pick_ids": " ".join(str(i) for i in picks.index) if picks is not None else "",
+            "pick_scores": " ".join(f"{s:g}" for s in picks["score"]) if picks is not None else "",
+        }
+        for stage in STAGES:
+            ns = rec["timings"].get(stage)
+            row[f"{stage}_ms"] = f"{ns / 1e6:.3f}" if ns is not None else ""
+        self.rows.append(row)
+        if len(self.rows) >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, "a", newline="", encoding="utf-8") as f:
+            w = csv.DictWriter(f, fieldnames=LOG_FIELDS)
+            if header:
+                w.writeheader()
+            w.writerows(self.rows)
+        self.rows = []
+
 # -------------------- MAIN --------------------
-def main():
-    books = load_books(CSV_PATH)
+def listings():
+    # (listing to fetch, subs it covers). The multireddit merges every sub into one
+    # newest-first listing, so one request replaces one per sub.
+    if MULTIREDDIT:
+        return [("+".join(ALLOWED_SUBS), [s.lower() for s in ALLOWED_SUBS])]
+    return [(sub, [sub.lower()]) for sub in ALLOWED_SUBS]
+
+def start():
+    books, index = load_catalog(CSV_PATH)
     reddit, me = connect()
-    replies = 0
+    db = open_state()
+    atexit.register(db.close)
+    # With history synced, the local index covers the whole age window and the
+    # comment-tree walk is redundant.
+    with api_stage("sync"):
+        verify = VERIFY_REPLIED and not sync_replied_from_history(reddit, me, db)
+    return books, index, reddit, me, db, verify
 
-    for sub in ALLOWED_SUBS:
-        print(f"\n=== r/{sub} ===")
-        for post in reddit.subreddit(sub).new(limit=LIMIT_PER_SUB):
-            if replies >= MAX_REPLIES_PER_RUN:
-                print(f"Reached MAX_REPLIES_PER_RUN ({MAX_REPLIES_PER_RUN}). Stopping.")
-                return
+def post_text(post):
+    return f"{post.title}\n\n{post.selftext or ''}"
 
-            text = f"{post.title}\n\n{post.selftext or ''}"
-            if not looks_like_request(text): 
-                continue
-            if not is_recent(post): 
-                continue
-            if str(post.author).lower() == me.lower(): 
+def screen_post(post, me, db, verify=False):
+    # Guardrails that need no scoring. Returns a skip reason, or None if the post is a candidate.
+    if not looks_like_request(post_text(post)):
+        return "not_request"
+    if str(post.author).lower() == me.lower():
+        return "own_post"
+    if already_replied(post, me, db, verify):
+        return "already_replied"
+    if Outbox(db).has(post.id):
+        return "in_outbox"
+    return None
+
+def evaluate_post(post, me, books, index, db, verify, rec=None):
+    # Guardrails, then extract -> pick -> render. Returns (reply or None, reason).
+    with timed(rec, "screen"):
+        reason = screen_post(post, me, db, verify)
+    if reason:
+        return None, reason
+    with timed(rec, "extract"):
+        prefs = extract_prefs(post_text(post), index)
+    with timed(rec, "score"):
+        picks = pick_books(books, prefs, k=4, index=index)
+    if rec is not None:
+        rec["prefs"], rec["picks"] = prefs, picks
+    if picks.empty:
+        return None, "no_picks"
+    with timed(rec, "render"):
+        reply = render_reply(prefs, picks)
+    return reply, "reply"
+
+def send_reply(post, reply, rec, db, backoff, me):
+    # Returns (ok, error): ok is True when sent, None to retry after the backoff it
+    # recorded, False to give up. Outbox posts are lazy, so the title fetch is inside the try.
+    # rec["unconfirmed"] marks a reply whose last attempt may have reached Reddit (a 5xx
+    # or network error, or an outbox row): the thread is checked before posting again.
+    sub = rec["sub"]
+    try:
+        if rec.pop("unconfirmed", False) and already_replied(post, me, db, verify=True):
+            backoff.succeeded(sub)
+            print(f"✅ An earlier attempt at {post.id} went through; not replying again.")
+            return True, ""
+        print("-"*80)
+        print(post.title, "|", post.permalink)
+        print(reply)
+        post.reply(reply)
+        mark_replied(db, post.id, sub)
+        backoff.succeeded(sub)
+        print("✅ Replied.")
+        return True, ""
+    except RedditAPIException as e:
+        wait = ratelimit_seconds(e)
+        if wait is not None:
+            backoff.ratelimited(sub, wait, str(e))
+            print(f"⏳ Rate limited in r/{sub}; holding replies there for {wait:.0f}s.")
+            return None, str(e)
+        print(f"⚠️ API error: {e}. Skipping this post.")
+        return False, str(e)
+    except APIException as e:
+        print(f"⚠️ API error: {e}. Skipping this post.")
+        return False, str(e)
+    except (prawcore.ServerError, prawcore.TooManyRequests, prawcore.RequestException) as e:
+        rec["unconfirmed"] = not isinstance(e, prawcore.TooManyRequests)   # a 429 was never processed
+        wait = backoff.server_error(str(e), getattr(e, "retry_after", None))
+        print(f"⏳ Reddit error ({e}); backing off {wait:.0f}s.")
+        return None, str(e)
+    except Exception as e:
+        print("⚠️ Unexpected error:\n", traceback.format_exc())
+        return False, repr(e)
+
+def logged_sender(db, backoff, records, log, me):
+    # The scheduler's send callback: times the reply and logs the post's outcome.
+    def send(post, reply):
+        rec = records[post.id]
+        with timed(rec, "reply"):
+            ok, error = send_reply(post, reply, rec, db, backoff, me)
+        if ok is None:
+            rec["reason"] = "backoff"   # re-queued; logged once it resolves
+            return ok, error
+        records.pop(post.id)
+        rec["decision"], rec["reason"] = ("replied", "") if ok else ("skipped", "send_failed")
+        log.write(rec)
+        return ok, error
+    return send
+
+def reply_scheduler(db, records, log, me, history=False):
+    backoff = Backoff(db)
+    return ReplyScheduler(logged_sender(db, backoff, records, log, me), hold=backoff.wait,
+                          outbox=Outbox(db), history=history)
+
+def resume_outbox(reddit, scheduler, records, horizon=float("inf")):
+    # Queue the replies earlier runs rendered but never sent, ahead of any new work.
+    # reddit.submission() is lazy: nothing is fetched until the send. A run can stop
+    # between post.reply and recording it, so each one is checked before it is re-sent.
+    due = scheduler.outbox.due(horizon)
+    for post_id, sub, body, attempts, created_utc in due:
+        post = reddit.submission(id=post_id)
+        records[post_id] = post_record(post, sub, created_utc)
+        records[post_id]["reason"] = "outbox"
+        records[post_id]["unconfirmed"] = True
+        scheduler.resume(post, body, sub, attempts)
+    if due:
+        print(f"Resuming {len(due)} replies from the outbox.")
+
+def collect_candidates(reddit, me, db, stats, records):
+    # Phase 1: walk every listing once and keep the posts that pass the cheap
+    # guardrails (the replied check is local only here). Returns
+    # {listing: (posts seen newest-first, candidates)}.
+    found = {}
+    for listing, subs in listings():
+        print(f"\n=== r/{listing} ===")
+        # Stop on the cursor's timestamp rather than passing `before=`: Reddit returns
+        # an empty listing when the cursor post has been removed or deleted.
+        _, cursor_utc = get_cursor(db, listing)
+        seen, candidates = [], []
+        # Page through the merged listing (limit=None) until every sub has LIMIT_PER_SUB
+        # posts or the age/cursor boundary is hit, so a busy sub can't crowd out a quiet one.
+        full = set()
+        for post in timed_fetch(listing, reddit.subreddit(listing).new(limit=None)):
+            # The listing is newest-first across every sub: once one post is too old
+            # (or already behind the cursor), so is everything after it, whatever its sub.
+            if not is_recent(post) or post.created_utc <= cursor_utc:
+                break
+            sub = post.subreddit.display_name.lower()
+            if sub not in subs:
                 continue
-            if already_replied(post, me): 
+            st = stats.setdefault(sub, {"seen": 0, "requests": 0, "replied": 0})
+            if st["seen"] >= LIMIT_PER_SUB:
+                full.add(sub)
+                if len(full) == len(subs):
+                    break
                 continue
+            st["seen"] += 1
+            if post.id in records:
+                continue   # resumed from the outbox
+            seen.append(post)
+            rec = records[post.id] = post_record(post)
+            with timed(rec, "screen"):
+                reason = screen_post(post, me, db)
+            rec["reason"] = reason or ""
+            if reason != "not_request":
+                st["requests"] += 1
+            if reason is None:
+                candidates.append(post)
+        found[listing] = (seen, candidates)
+    return found
 
-            prefs = extract_prefs(text)
-            picks = pick_books(books, prefs, k=4)
-            if picks.empty: 
-                continue
+def rank_candidates(candidates, books, index, records):
+    # Phase 2: score every candidate, strongest picks first, fresher posts winning ties.
+    ranked, prefs_list = [], []
+    for post in candidates:
+        with timed(records[post.id], "extract"):
+            prefs_list.append(extract_prefs(post_text(post), index))
+    t0 = time.perf_counter_ns()
+    picks_list = pick_books_batch(books, prefs_list, k=4, index=index)
+    # One batch product scores them all; each post is charged an equal share.
+    share = (time.perf_counter_ns() - t0) // max(len(candidates), 1)
+    for post, prefs, picks in zip(candidates, prefs_list, picks_list):
+        rec = records[post.id]
+        rec["prefs"], rec["picks"] = prefs, picks
+        add_timing(rec, "score", share)
+        if picks.empty:
+            rec["reason"] = "no_picks"
+        else:
+            rec["reason"] = "outranked"   # until it is chosen below
+            ranked.append((float(picks["score"].sum()), post.created_utc, post, prefs, picks))
+    ranked.sort(key=lambda r: (r[0], r[1]), reverse=True)
+    return ranked
 
-            reply = render_reply(prefs, picks)
-            print("-"*80)
-            print(post.title, "|", post.permalink)
-            print(reply)
+def advance_cursor(db, listing, seen, pending):
+    # Move the cursor as far as the newest post with nothing pending at or behind it,
+    # so candidates that lost out this run are seen again next run.
+    last = max((i for i, p in enumerate(seen) if p.id in pending), default=-1)
+    if last + 1 < len(seen):
+        newest = seen[0] if last < 0 else seen[last + 1]
+        set_cursor(db, listing, newest.fullname, newest.created_utc)
 
-            try:
-                post.reply(reply)
-                replies += 1
-                print(f"✅ Replied. Cooldown {COOLDOWN_SECONDS}s…")
-                time.sleep(COOLDOWN_SECONDS)
-            except (APIException, RedditAPIException) as e:
-                print(f"⚠️ API error: {e}. Skipping this post.")
-                time.sleep(10)
-            except Exception:
-                print("⚠️ Unexpected error:\n", traceback.format_exc())
-                time.sleep(10)
-
-    print(f"Done. Total replies this run: {replies}")
+def main():
+    started = time.time()
+    books, index, reddit, me, db, verify = start()
+    records, log = {}, RunLog()
+    scheduler = reply_scheduler(db, records, log, me, history=True)
+    stats = {}
+
+    try:
+        resume_outbox(reddit, scheduler, records, horizon=started + RUN_BUDGET_SECONDS)
+        scheduler.pump()
+        found = collect_candidates(reddit, me, db, stats, records)
+        candidates = [p for _, cands in found.values() for p in cands]
+        ranked = rank_candidates(candidates, books, index, records)
+        print(f"\nRanked {len(ranked)} of {len(candidates)} candidate posts; "
+              f"replying to the best {MAX_REPLIES_PER_RUN}.")
+
+        pending = {post.id for _, _, post, _, _ in ranked}
+        for score, _, post, prefs, picks in ranked:
+            if len(scheduler.queue) + scheduler.sent_count + scheduler.failed_count >= MAX_REPLIES_PER_RUN:
+                break
+            rec = records[post.id]
+            # The comment-tree walk (if still enabled) is only paid for posts we'd answer.
+            if verify:
+                with timed(rec, "verify"):
+                    replied = already_replied(post, me, db, verify)
+                if replied:
+                    rec["reason"] = "already_replied"
+                    pending.discard(post.id)
+                    continue
+            with timed(rec, "render"):
+                reply = render_reply(prefs, picks)
+            scheduler.submit(post, reply, post.subreddit.display_name.lower())
+            scheduler.pump()
+
+        scheduler.drain(deadline=started + RUN_BUDGET_SECONDS)
+        for post, _, _ in scheduler.queue:
+            records[post.id]["reason"] = "run_budget"
+        for post, _, _ in scheduler.failed:
+            if post.id in records:
+                records[post.id]["reason"] = "retries_exhausted"
+        pending -= {post.id for post, _, _ in scheduler.sent}
+        for listing, (seen, _) in found.items():
+            advance_cursor(db, listing, seen, pending)
+    finally:
+        # Log every post this run looked at, however the run ended, and get the rows
+        # on disk now rather than relying on the atexit hook.
+        for rec in records.values():
+            log.write(rec)
+        records.clear()
+        log.flush()
+
+    for post, _, sub in scheduler.sent:
+        stats.setdefault(sub, {"seen": 0, "requests": 0, "replied": 0})["replied"] += 1
+    print_stats(stats)
+    print(f"Pick cache: {PICK_CACHE.hits} hits, {PICK_CACHE.misses} misses.")
+    LATENCY.report()
+    API_USAGE.report()
+    write_metrics()
+    print(f"Done. Total replies this run: {scheduler.sent_count}")
+
+def catalog_stamp():
+    paths = (CSV_PATH, os.path.join(CATALOG_PATH, "manifest.json"))
+    return tuple(os.stat(p).st_mtime_ns if os.path.exists(p) else None for p in paths)
+
+def run_daemon():
+    # Load and authenticate once, then answer posts as the stream delivers them.
+    # The stream replays recent posts on (re)connect; the replied index makes that cheap.
+    books, index, reddit, me, db, verify = start()
+    records, log = {}, RunLog()
+    scheduler = reply_scheduler(db, records, log, me)
+    resume_outbox(reddit, scheduler, records)
+    stamp = catalog_stamp()
+    listing = "+".join(ALLOWED_SUBS)
+    print(f"Streaming r/{listing} …")
+    while True:
+        try:
+            for post in reddit.subreddit(listing).stream.submissions(pause_after=STREAM_PAUSE_AFTER):
+                scheduler.pump()
+                if post is None:
+                    # Idle tick: log finished replies, flush the run log and pick up a
+                    # recompiled or edited catalog. Its new version invalidates the pick
+                    # cache on the next lookup.
+                    # Replies that ran out of attempts left the queue without a log row.
+                    queued = {p.id for p, _, _ in scheduler.queue}
+                    for post_id in [pid for pid in records if pid not in queued]:
+                        rec = records.pop(post_id)
+                        rec["reason"] = "retries_exhausted"
+                        log.write(rec)
+                    log.flush()
+                    write_metrics()
+                    if catalog_stamp() != stamp:
+                        stamp = catalog_stamp()
+                        books, index = load_catalog(CSV_PATH)
+                        print(f"Reloaded catalog ({len(books)} books). "
+                              f"Pick cache: {PICK_CACHE.hits} hits, {PICK_CACHE.misses} misses.")
+                    continue
+                if not is_recent(post):
+                    continue
+                rec = post_record(post)
+                reply, reason = evaluate_post(post, me, books, index, db, verify, rec)
+                if reply is None:
+                    rec["reason"] = reason
+                    log.write(rec)
+                else:
+                    records[post.id] = rec
+                    scheduler.submit(post, reply, rec["sub"])
+        except KeyboardInterrupt:
+            print("Stopping daemon.")
+            return
+        except Exception:
+            print("⚠️ Stream error, reconnecting in 30s:\n", traceback.format_exc())
+            time.sleep(30)
+
+def print_stats(stats):
+    for sub, st in sorted(stats.items()):
+        print(f"r/{sub}: {st['seen']} seen, {st['requests']} requests, {st['replied']} replied")
 
 if __name__ == "__main__":
-    main()
+    ap = argparse.ArgumentParser(description="KUBookRecs auto-reply bot")
+    ap.add_argument("command", nargs="?", default="run", choices=["run", "compile-catalog"],
+                    help="compile-catalog writes CATALOG_PATH from the CSV and exits")
+    ap.add_argument("--daemon", action="store_true",
+                    help="stay running and reply from the live submission stream")
+    args = ap.parse_args()
+    # SIGTERM (job timeout, container stop) unwinds like an exception, so finally
+    # blocks and atexit hooks still flush the run log and close the state DB.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+    if args.command == "compile-catalog":
+        compile_catalog()
+    elif args.daemon:
+        run_daemon()
+    else:
+        main()
@@ -0,0 +1,65 @@
+import time
+import types
+
+import pytest
+
+import kubookrecs_bot_live_log as bot
+
+
+@pytest.fixture
+def db():
+    return bot.open_state(":memory:")
+
+
+def listing(n):
+    # n posts, newest first, a minute apart.
+    now = time.time()
+    return [types.SimpleNamespace(id=f"p{i}", fullname=f"t3_p{i}", created_utc=now - 60 * i) for i in range(n)]
+
+
+def test_no_pending_posts_moves_cursor_to_the_newest(db):
+    seen = listing(5)
+    bot.advance_cursor(db, "books", seen, set())
+    assert bot.get_cursor(db, "books") == ("t3_p0", seen[0].created_utc)
+
+
+def test_pending_post_keeps_the_cursor_behind_it(db):
+    seen = listing(5)
+    bot.advance_cursor(db, "books", seen, {"p2"})
+    # Next run stops at p3, so p2 (and the newer, handled p0/p1) are seen again.
+    assert bot.get_cursor(db, "books") == ("t3_p3", seen[3].created_utc)
+
+
+def test_oldest_pending_post_wins(db):
+    seen = listing(5)
+    bot.advance_cursor(db, "books", seen, {"p1", "p3"})
+    assert bot.get_cursor(db, "books")[0] == "t3_p4"
+
+
+def test_pending_oldest_post_leaves_cursor_where_it_was(db):
+    old = listing(8)
+    bot.set_cursor(db, "books", old[7].fullname, old[7].created_utc)
+    bot.advance_cursor(db, "books", old[:5], {"p4"})
+    assert bot.get_cursor(db, "books")[0] == "t3_p7"
+
+
+def test_empty_listing_leaves_cursor_alone(db):
+    bot.advance_cursor(db, "books", [], set())
+    assert bot.get_cursor(db, "books") == (None, 0.0)
+
+
+@pytest.mark.parametrize("outcome", [(False, "403"), (None, "502")])
+def test_failed_or_unsent_reply_keeps_the_cursor_back(db, monkeypatch, outcome):
+    # As main() does it: ranked posts stay pending until the scheduler has sent them.
+    monkeypatch.setattr(bot, "REPLY_BURST", 2)
+    monkeypatch.setattr(bot, "SUB_REPLY_BURST", 2)
+    seen = listing(6)
+    results = {"p1": (True, ""), "p4": outcome}
+    scheduler = bot.ReplyScheduler(lambda post, reply: results[post.id], history=True)
+    pending = set(results)
+    for post in (seen[1], seen[4]):
+        scheduler.submit(post, "hi", "books")
+    scheduler.pump()
+    pending -= {post.id for post, _, _ in scheduler.sent}
+    bot.advance_cursor(db, "books", seen, pending)
+    assert bot.get_cursor(db, "books")[0] == "t3_p5"
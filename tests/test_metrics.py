@@ -0,0 +1,46 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+import kubookrecs_bot_live_log as bot
+
+# Within a bucket the values differ by under one part in 2**(HIST_SUB_BITS - 1).
+MAX_REL_ERROR = 1 / 2 ** (bot.HIST_SUB_BITS - 1)
+
+
+def test_bucket_bounds_hold_its_values():
+    H = bot.Histogram
+    values = list(range(5000)) + [2 ** e + d for e in range(12, 50) for d in (-1, 0, 1, 12345)]
+    for v in values:
+        i = H.bucket(v)
+        assert H.bucket_high(i) >= v
+        assert i == 0 or H.bucket_high(i - 1) < v
+        assert H.bucket_high(i) - v <= max(v * MAX_REL_ERROR, 0)
+
+
+@pytest.mark.parametrize("scale", [1e3, 1e6, 1e9, 1e12])
+def test_quantiles_within_stated_error(scale):
+    rng = np.random.default_rng(int(math.log10(scale)))
+    values = (rng.lognormal(0, 1.5, 20000) * scale).astype(np.int64)
+    h = bot.Histogram()
+    for v in values:
+        h.record(int(v))
+    ordered = np.sort(values)
+    for q in (0.5, 0.9, 0.95, 0.99, 0.999, 1.0):
+        exact = int(ordered[max(math.ceil(q * len(values)), 1) - 1])
+        got = h.quantile(q)
+        assert exact <= got <= exact * (1 + MAX_REL_ERROR)
+    assert h.quantile(1.0) == h.max == int(values.max())
+
+
+def test_merge_matches_recording_everything_in_one():
+    rng = random.Random(0)
+    values = [rng.randrange(1, 10 ** 9) for _ in range(3000)]
+    whole, a, b = bot.Histogram(), bot.Histogram(), bot.Histogram()
+    for i, v in enumerate(values):
+        whole.record(v)
+        (a if i % 2 else b).record(v)
+    a.merge(b)
+    assert (a.counts, a.count, a.total, a.max) == (whole.counts, whole.count, whole.total, whole.max)
@@ -0,0 +1,57 @@
+import pytest
+
+import kubookrecs_bot_live_log as bot
+
+EMPTY = {"genres_like": [], "tropes": [], "vibes": [], "heat": None, "ku": None, "audio": None,
+         "hard_nopes": [], "max_pages": None, "comps_like": []}
+
+# What the original substring-based extract_prefs returned for each text.
+BASELINE = {
+    "Looking for a cozy mystery on KU, under 300 pages, no gore please":
+        {"genres_like": ["cozy mystery", "mystery"], "vibes": ["cozy"], "ku": True,
+         "hard_nopes": ["gore"], "max_pages": 300},
+    "recommend WWII historical fiction, hopeful, no animal death":
+        {"genres_like": ["historical fiction", "WWII historical fiction"], "vibes": ["hopeful"],
+         "hard_nopes": ["animal death"]},
+    "What should I read? sci-fi heist with found family, audiobook":
+        {"genres_like": ["sci-fi"], "tropes": ["found family", "heist"], "audio": True},
+    "Suggest a slow burn romance, spicy, like Fourth Wing":
+        {"genres_like": ["romance"], "tropes": ["slow burn"], "heat": "open", "comps_like": ["Fourth Wing"]},
+    "I want a dark fantasy with enemies to lovers, closed door":
+        {"genres_like": ["fantasy"], "tropes": ["enemies to lovers"], "vibes": ["dark"], "heat": "closed"},
+    "Need a fast-paced thriller, fade to black is fine, Kindle Unlimited":
+        {"genres_like": ["thriller"], "vibes": ["fast"], "heat": "fade", "ku": True},
+    "romantic suspense with a grumpy sunshine pairing and forced proximity":
+        {"genres_like": ["romantic suspense"], "tropes": ["grumpy sunshine", "forced proximity"]},
+    "epic space opera, gritty and atmospheric, no cheating":
+        {"genres_like": ["space opera"], "vibes": ["gritty", "atmospheric", "epic"], "hard_nopes": ["cheating"]},
+    "Any enemies-to-lovers romances? Something witty":
+        {"genres_like": ["romance"], "vibes": ["witty"]},
+    "A book to read over breakfast, nothing dark":
+        {"vibes": ["dark", "fast"]},
+    "I love heists and found families":
+        {"tropes": ["heist"]},
+    "Something cozy – I’m done with dark stuff. Women’s fiction maybe":
+        {"vibes": ["dark", "cozy"]},
+    "": {},
+}
+
+# The intended differences from the baseline; every other field must match it.
+CHANGED = {
+    # Hyphens split words, so the hyphenated trope matches.
+    "Any enemies-to-lovers romances? Something witty": {"tropes": ["enemies to lovers"]},
+    # Terms match whole words: "breakfast" is not the "fast" vibe.
+    "A book to read over breakfast, nothing dark": {"vibes": ["dark"]},
+    # Plurals of the last word match, including -y -> -ies.
+    "I love heists and found families": {"tropes": ["found family", "heist"]},
+    # U+2019 apostrophes read as "'".
+    "Something cozy – I’m done with dark stuff. Women’s fiction maybe":
+        {"genres_like": ["women's fiction"]},
+}
+
+
+@pytest.mark.parametrize("text", list(BASELINE))
+def test_extract_prefs_matches_baseline_except_listed_changes(text):
+    expected = {**EMPTY, **BASELINE[text], **CHANGED.get(text, {})}
+    prefs = bot.extract_prefs(text)
+    assert {k: prefs[k] for k in EMPTY} == expected
@@ -0,0 +1,253 @@
+import time
+import types
+
+import prawcore
+import pytest
+from praw.exceptions import RedditAPIException, RedditErrorItem
+
+import kubookrecs_bot_live_log as bot
+
+ME = "botuser"
+
+
+class FakePost:
+    def __init__(self, post_id, sub="books", fail=()):
+        self.id, self.subreddit, self.title, self.permalink = post_id, sub, post_id, f"/r/{sub}/{post_id}"
+        self.created_utc = time.time()
+        self.fail = list(fail)   # exceptions raised by successive reply() calls
+        self.posted, self.calls = [], 0
+        self.comments = types.SimpleNamespace(replace_more=lambda limit=0: None, list=lambda: self.posted)
+
+    def reply(self, body):
+        # Like Reddit on a 502 after the write: the comment exists even when the call
+        # fails. A 429 is refused before the write.
+        self.calls += 1
+        if self.fail and isinstance(self.fail[0], prawcore.TooManyRequests):
+            raise self.fail.pop(0)
+        self.posted.append(types.SimpleNamespace(author=ME, created_utc=time.time(), body=body))
+        if self.fail:
+            raise self.fail.pop(0)
+
+
+def http_error(cls, status):
+    return cls(types.SimpleNamespace(status_code=status, headers={}, text=""))
+
+
+@pytest.fixture
+def db():
+    return bot.open_state(":memory:")
+
+
+def test_retry_after_server_error_finds_the_earlier_reply(db):
+    post = FakePost("p1", fail=[http_error(prawcore.ServerError, 502)])
+    rec = bot.post_record(post, "books", post.created_utc)
+    backoff = bot.Backoff(db)
+    assert bot.send_reply(post, "hi", rec, db, backoff, ME)[0] is None
+    assert bot.send_reply(post, "hi", rec, db, backoff, ME) == (True, "")
+    assert post.calls == 1
+    assert bot.was_replied(db, "p1")
+
+
+def test_retry_after_429_sends_again(db):
+    post = FakePost("p1", fail=[http_error(prawcore.TooManyRequests, 429)])
+    rec = bot.post_record(post, "books", post.created_utc)
+    backoff = bot.Backoff(db)
+    assert bot.send_reply(post, "hi", rec, db, backoff, ME)[0] is None
+    assert not rec["unconfirmed"]
+    assert bot.send_reply(post, "hi", rec, db, backoff, ME) == (True, "")
+    assert post.calls == 2
+
+
+class Clock:
+    def __init__(self, t=0.0):
+        self.t = t
+
+    def __call__(self):
+        return self.t
+
+
+def item(post_id):
+    return types.SimpleNamespace(id=post_id)
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    # One reply a second account-wide (burst 2); one an hour per sub (burst 1).
+    monkeypatch.setattr(bot, "REPLY_RATE_PER_MIN", 60)
+    monkeypatch.setattr(bot, "REPLY_BURST", 2)
+    monkeypatch.setattr(bot, "SUB_REPLY_RATE_PER_HOUR", 1)
+    monkeypatch.setattr(bot, "SUB_REPLY_BURST", 1)
+    monkeypatch.setattr(bot, "MAX_SEND_ATTEMPTS", 3)
+
+
+def scheduler(results=None, hold=lambda sub: 0.0):
+    # Records the post ids sent; send() answers from `results` (default: success).
+    sent = []
+    def send(post, reply):
+        sent.append(post.id)
+        return (results or {}).get(post.id, (True, ""))
+    clock = Clock()
+    return bot.ReplyScheduler(send, clock=clock, hold=hold), clock, sent
+
+
+def test_token_bucket_rate_and_burst():
+    b = bot.TokenBucket(rate=0.5, burst=2, now=0.0)
+    assert b.wait(0.0) == 0.0
+    b.take(0.0)
+    b.take(0.0)
+    assert b.wait(0.0) == pytest.approx(2.0)
+    assert b.wait(1.0) == pytest.approx(1.0)
+    assert b.wait(2.0) == 0.0
+    # Idle time refills only up to the burst.
+    b.take(100.0)
+    b.take(100.0)
+    assert b.wait(100.0) == pytest.approx(2.0)
+
+
+def test_account_bucket_limits_every_sub(limits):
+    s, clock, sent = scheduler()
+    for i, sub in enumerate("abcd"):
+        s.submit(item(f"p{i}"), "hi", sub)
+    assert s.pump() == 2            # the burst
+    assert s.pump() == 0
+    assert s.next_wait() == pytest.approx(1.0)
+    clock.t = 1.0
+    assert s.pump() == 1
+    clock.t = 2.0
+    assert s.pump() == 1
+    assert sent == ["p0", "p1", "p2", "p3"] and s.sent_count == 4 and not s.queue
+
+
+def test_sub_over_its_limit_does_not_block_other_subs(limits):
+    s, clock, sent = scheduler()
+    s.submit(item("a1"), "hi", "a")
+    s.submit(item("a2"), "hi", "a")
+    s.submit(item("b1"), "hi", "b")
+    assert s.pump() == 2
+    assert sent == ["a1", "b1"]
+    assert s.next_wait() == pytest.approx(3600.0)   # a2 waits for r/a's bucket
+    clock.t = 3600.0
+    assert s.pump() == 1 and sent[-1] == "a2"
+
+
+def test_held_sub_is_skipped_and_account_hold_stops_all(limits):
+    held = {"a": 60.0}
+    s, clock, sent = scheduler(hold=lambda sub: held.get(sub, 0.0))
+    s.submit(item("a1"), "hi", "a")
+    s.submit(item("b1"), "hi", "b")
+    assert s.pump() == 1 and sent == ["b1"]
+    assert s.next_wait() == pytest.approx(60.0)
+    held[None] = 30.0
+    held["a"] = 0.0
+    clock.t = 5.0
+    assert s.pump() == 0
+    del held[None]
+    assert s.pump() == 1 and sent == ["b1", "a1"]
+
+
+def test_retry_requeues_until_max_send_attempts(limits):
+    s, clock, sent = scheduler(results={"a1": (None, "502")})
+    s.submit(item("a1"), "hi", "a")
+    for t in range(3):
+        clock.t = t * 3600.0
+        s.pump()
+        assert sent.count("a1") == t + 1
+    assert not s.queue and not s.attempts
+    assert (s.sent_count, s.failed_count) == (0, 1)
+    clock.t = 4 * 3600.0
+    assert s.pump() == 0 and len(sent) == 3
+
+
+def test_history_keeps_finished_items_only_when_asked(limits):
+    s, _, _ = scheduler(results={"b1": (False, "403")})
+    s.history = True
+    s.submit(item("a1"), "hi", "a")
+    s.submit(item("b1"), "hi", "b")
+    s.pump()
+    assert [p.id for p, _, _ in s.sent] == ["a1"] and [p.id for p, _, _ in s.failed] == ["b1"]
+    s, _, _ = scheduler()
+    s.submit(item("a1"), "hi", "a")
+    s.pump()
+    assert s.sent == [] and s.sent_count == 1
+
+
+def api_error(*items):
+    return RedditAPIException([RedditErrorItem(kind, message=msg) for kind, msg in items])
+
+
+@pytest.mark.parametrize("message, seconds", [
+    ("Take a break for 7 minutes before trying again.", 8 * 60),   # one unit of slack
+    ("you are doing that too much. try again in 1 minute.", 2 * 60),
+    ("Take a break for 45 seconds before trying again.", 46),
+    ("Take a break for 2 hours before trying again.", 3 * 3600),
+])
+def test_ratelimit_seconds_parses_the_wait(message, seconds):
+    assert bot.ratelimit_seconds(api_error(("RATELIMIT", message))) == seconds
+
+
+def test_ratelimit_seconds_takes_the_longest_and_ignores_other_items():
+    e = api_error(("RATELIMIT", "try again in 3 minutes"), ("THREAD_LOCKED", "locked"),
+                  ("RATELIMIT", "try again in 10 seconds"))
+    assert bot.ratelimit_seconds(e) == 4 * 60
+    assert bot.ratelimit_seconds(api_error(("RATELIMIT", "slow down"))) == bot.BACKOFF_BASE_SECONDS
+    assert bot.ratelimit_seconds(api_error(("THREAD_LOCKED", "locked"))) is None
+    assert bot.ratelimit_seconds(ValueError("boom")) is None
+
+
+def test_ratelimit_holds_only_that_sub_and_persists(db):
+    clock = Clock(1000.0)
+    backoff = bot.Backoff(db, clock=clock)
+    backoff.ratelimited("a", 480, "RATELIMIT")
+    assert backoff.wait("a") == 480 and backoff.wait("b") == 0 and backoff.wait() == 0
+    clock.t += 100
+    assert bot.Backoff(db, clock=clock).wait("a") == 380   # reloaded from the state DB
+    backoff.succeeded("a")
+    assert backoff.wait("a") == 0 and bot.Backoff(db, clock=clock).wait("a") == 0
+
+
+def test_server_errors_back_off_exponentially_with_jitter(db, monkeypatch):
+    monkeypatch.setattr(bot, "BACKOFF_BASE_SECONDS", 30.0)
+    monkeypatch.setattr(bot, "BACKOFF_MAX_SECONDS", 200.0)
+    backoff = bot.Backoff(db, clock=Clock(0.0))
+    for cap in (30, 60, 120, 200, 200):
+        delay = backoff.server_error("502")
+        assert cap / 2 <= delay <= cap
+        assert backoff.wait() == delay and backoff.wait("any") == delay
+    assert backoff.server_error("429", retry_after="900") == 900
+    backoff.succeeded("any")
+    assert backoff.wait() == 0
+    assert backoff.server_error("502") <= 30   # success resets the exponent
+
+
+def outbox_status(db):
+    return dict(db.execute("SELECT post_id, status FROM outbox"))
+
+
+def test_outbox_due_closes_out_old_spent_and_sent_rows(db, monkeypatch):
+    monkeypatch.setattr(bot, "MAX_SEND_ATTEMPTS", 3)
+    outbox = bot.Outbox(db)
+    for post_id in ("fresh", "old", "spent", "landed", "later"):
+        outbox.put(post_id, "books", f"reply to {post_id}")
+    now = time.time()
+    db.execute("UPDATE outbox SET created_utc = ? WHERE post_id = 'old'", (now - (bot.MAX_POST_AGE_HOURS + 1) * 3600,))
+    outbox.update("spent", "pending", 3, now, "502")
+    outbox.update("later", "pending", 1, now + 600, "502")
+    bot.mark_replied(db, "landed", "books")   # sent, but the run stopped before recording it
+    assert [r[0] for r in outbox.due(now + 60)] == ["fresh"]
+    assert outbox_status(db) == {"fresh": "pending", "old": "expired", "spent": "failed",
+                                 "landed": "sent", "later": "pending"}
+    assert [r[0] for r in outbox.due(float("inf"))] == ["fresh", "later"]
+
+
+def test_scheduler_records_outcomes_in_the_outbox(db, limits, monkeypatch):
+    monkeypatch.setattr(bot, "REPLY_BURST", 3)
+    outbox = bot.Outbox(db)
+    results = {"a1": (True, ""), "b1": (False, "403"), "c1": (None, "502")}
+    s = bot.ReplyScheduler(lambda post, reply: results[post.id], clock=Clock(), outbox=outbox)
+    for post_id in results:
+        s.submit(item(post_id), "hi", post_id[0])
+    assert outbox_status(db) == {"a1": "pending", "b1": "pending", "c1": "pending"}
+    s.pump()
+    assert outbox_status(db) == {"a1": "sent", "b1": "failed", "c1": "pending"}
+    assert db.execute("SELECT attempts, last_error FROM outbox WHERE post_id = 'c1'").fetchone() == (1, "502")
+    assert [(r[0], r[3]) for r in outbox.due(float("inf"))] == [("c1", 1)]
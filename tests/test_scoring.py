@@ -0,0 +1,156 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import kubookrecs_bot_live_log as bot
+
+GENRES = ["cozy mystery", "romance", "sci-fi", "fantasy", "thriller", "historical fiction",
+          "WWII historical fiction", "horror", "romantasy", "literary fiction"]
+TROPES = ["found family", "enemies to lovers", "slow burn", "heist", "amateur sleuth",
+          "dual timeline", "second chance", "forced proximity"]
+VIBES = ["cozy", "dark", "hopeful", "witty", "bittersweet", "tense", "whimsical"]
+HEAT = ["closed", "fade", "open"]
+NOTES = ["gore", "animal death", "war violence", "mild peril", "abduction", "self-harm",
+         "child endangerment", "no gore", "zero pet peril"]
+TITLES = ["The Quiet Orchard", "Starlight Heist", "A Death in Cotswold", "The Maid's Secret",
+          "Salt and Stars", "The Clockmaker's Niece", "Undercover Heart", "Ash Crown"]
+AUTHORS = ["Jane Willow", "Rey Calder", "E. Harland", "M. Vale", "Shari J. Ryan", "Ana Moss"]
+WORDS = ["sisterhood", "banter", "puzzle", "crew", "survival", "village", "stakes", "magic",
+         "ship", "letters", "river", "war", "secret", "family", "court"]
+
+
+def pick(rng, vocab, lo=1, hi=3):
+    return "|".join(rng.sample(vocab, rng.randint(lo, hi)))
+
+
+@pytest.fixture(scope="module")
+def catalog_csv(tmp_path_factory):
+    rng = random.Random(7)
+    rows = []
+    for i in range(300):
+        rows.append({
+            "title": f"{rng.choice(TITLES)} {i}", "author": rng.choice(AUTHORS),
+            "year": str(rng.randint(1990, 2025)), "genres": pick(rng, GENRES),
+            "tropes": pick(rng, TROPES), "vibes": pick(rng, VIBES), "heat": rng.choice(HEAT),
+            "pacing": "steady", "format_availability": "ebook",
+            "ku": rng.choice(["True", "False"]), "audio": rng.choice(["True", "False"]),
+            "pages": str(rng.randint(150, 600)), "content_notes": "; ".join(rng.sample(NOTES, 2)),
+            "comps": pick(rng, TITLES, 1, 2), "hook_line": " ".join(rng.sample(WORDS, 5)),
+            "why_readers_might_like": " ".join(rng.sample(WORDS, 6)),
+        })
+    path = tmp_path_factory.mktemp("catalog") / "books.csv"
+    pd.DataFrame(rows).to_csv(path, index=False)
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def catalog(catalog_csv):
+    return bot.load_catalog(catalog_csv, artifact=None)
+
+
+def random_prefs(rng):
+    sub = lambda vocab: [t.lower()[:rng.randint(3, len(t))] for t in rng.sample(vocab, rng.randint(0, 2))]
+    return {
+        "genres_like": sub(GENRES), "tropes": sub(TROPES), "vibes": sub(VIBES),
+        "heat": rng.choice([None] + HEAT), "ku": rng.choice([None, True]),
+        "audio": rng.choice([None, True]), "hard_nopes": sub(NOTES),
+        "max_pages": rng.choice([None, 250, 400]), "comps_like": rng.sample(TITLES, rng.randint(0, 2)),
+        "read_titles": [], "like_titles": [], "text_terms": [],
+    }
+
+
+def random_text(rng):
+    parts = (rng.sample(GENRES, 1) + rng.sample(TROPES, rng.randint(0, 2)) + rng.sample(VIBES, rng.randint(0, 1))
+             + rng.sample(WORDS, rng.randint(0, 3)))
+    if rng.random() < 0.3: parts.append(f"no {rng.choice(['gore', 'animal death', 'abduction'])}")
+    if rng.random() < 0.3: parts.append(f"under {rng.choice([250, 400])} pages")
+    if rng.random() < 0.3: parts.append(f"like {rng.choice(TITLES)}")
+    if rng.random() < 0.3: parts.append(rng.choice(["on KU", "audiobook", "spicy", "closed door"]))
+    return "recommend " + ", ".join(parts)
+
+
+def assert_same_picks(a, b):
+    assert list(a.index) == list(b.index)
+    np.testing.assert_allclose(a["score"].to_numpy(), b["score"].to_numpy(), rtol=0, atol=1e-9)
+
+
+def test_score_frame_matches_score_row(catalog):
+    books, _ = catalog
+    rng = random.Random(1)
+    for _ in range(200):
+        prefs = random_prefs(rng)
+        expected = books.apply(lambda r: bot.score_row(r, prefs), axis=1).to_numpy()
+        np.testing.assert_array_equal(bot.score_frame(books, prefs), expected)
+
+
+def test_vectorized_and_rowwise_picks_match(catalog, monkeypatch):
+    books, _ = catalog
+    rng = random.Random(2)
+    for _ in range(50):
+        prefs = random_prefs(rng)
+        monkeypatch.setattr(bot, "SCORING_MODE", "rowwise")
+        rowwise = bot.score_picks(books, prefs)
+        monkeypatch.setattr(bot, "SCORING_MODE", "vectorized")
+        assert_same_picks(bot.score_picks(books, prefs), rowwise)
+
+
+@pytest.mark.parametrize("strict", [False, True])
+def test_rowwise_with_index_matches_candidates(catalog, monkeypatch, strict):
+    books, index = catalog
+    monkeypatch.setattr(bot, "STRICT_FILTERS", strict)
+    rng = random.Random(5)
+    for _ in range(40):
+        prefs = bot.extract_prefs(random_text(rng) + ". " + " ".join(rng.sample(WORDS, 3)), index)
+        monkeypatch.setattr(bot, "SCORING_MODE", "rowwise")
+        rowwise = bot.score_picks(books, prefs, index=index)
+        monkeypatch.setattr(bot, "SCORING_MODE", "vectorized")
+        assert_same_picks(bot.score_picks(books, prefs, index=index), rowwise)
+
+
+def test_one_shared_word_makes_no_picks(catalog):
+    books, index = catalog
+    prefs = bot.extract_prefs("Can anyone recommend a book about a dog? My family loved the last one.", index)
+    assert prefs["text_terms"] == ["family"]
+    assert bot.soft_boosts(index, prefs) == []
+    assert bot.score_picks(books, prefs, index=index).empty
+
+
+@pytest.mark.parametrize("strict", [False, True])
+@pytest.mark.parametrize("mmr_lambda", [1.0, 0.7])
+def test_batch_matches_single_picks(catalog, monkeypatch, strict, mmr_lambda):
+    books, index = catalog
+    monkeypatch.setattr(bot, "STRICT_FILTERS", strict)
+    monkeypatch.setattr(bot, "MMR_LAMBDA", mmr_lambda)
+    monkeypatch.setattr(bot, "PICK_CACHE", bot.PickCache(1024))
+    monkeypatch.setattr(bot, "BATCH_CELLS", index["n"] * 7)   # several blocks
+    rng = random.Random(3)
+    prefs_list = [bot.extract_prefs(random_text(rng), index) for _ in range(60)]
+    prefs_list += prefs_list[:5]   # repeats go through the cache
+    batch = bot.pick_books_batch(books, prefs_list, k=4, index=index)
+    for prefs, picks in zip(prefs_list, batch):
+        assert_same_picks(picks, bot.score_picks(books, prefs, k=4, index=index))
+
+
+def test_compiled_catalog_matches_csv(catalog, catalog_csv, tmp_path, monkeypatch):
+    books, index = catalog
+    artifact = str(tmp_path / "books.catalog")
+    bot.compile_catalog(catalog_csv, artifact)
+    assert bot.artifact_is_fresh(artifact, catalog_csv)
+    cbooks, cindex = bot.load_catalog(catalog_csv, artifact)
+    pd.testing.assert_frame_equal(cbooks, books)
+    monkeypatch.setattr(bot, "PICK_CACHE", bot.PickCache(0))
+    rng = random.Random(4)
+    for _ in range(40):
+        text = random_text(rng) + f". I already read {rng.choice(list(books['title']))}"
+        prefs = bot.extract_prefs(text, index)
+        assert bot.extract_prefs(text, cindex) == prefs
+        assert_same_picks(bot.score_picks(cbooks, prefs, index=cindex), bot.score_picks(books, prefs, index=index))
+
+
+def test_top_k_breaks_ties_by_year_then_row():
+    scores = np.array([2.0, 3.0, 2.0, 2.0, 0.0, 2.0])
+    rows = np.arange(6)
+    years = np.array([2001, 1999, 2010, 2001, 2020, 2010])
+    assert list(rows[bot.top_k(scores, rows, years, 4)]) == [1, 2, 5, 0]